@@ -0,0 +1,357 @@
+#  -*- coding: iso-8859-1 -*-
+# one supervisor process running many sessions, controlled over a unix socket
+# with one json request and one json response line per connection
+
+import os
+import json
+import time
+import errno
+import socket
+import logging
+from collections import deque
+
+import setenv
+from salome_utils import getLauncherCacheDir,removeFiles
+from salome_supervisor import Supervisor,ShutdownRequested,RestartPolicy,\
+        describe_status,terminate
+
+logger = logging.getLogger('salome')
+
+# states of a session
+STARTING = 'starting'
+RUNNING = 'running'
+STOPPING = 'stopping'
+STOPPED = 'stopped'
+FAILED = 'failed'
+
+
+def default_socket():
+    return os.path.join(getLauncherCacheDir(),'daemon.sock')
+
+def request(command, socketpath=None, timeout=30., **kwargs):
+    """Send a request to the daemon and return its response"""
+    kwargs['command'] = command
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socketpath or default_socket())
+        sock.sendall((json.dumps(kwargs)+'\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode('utf-8'))
+
+def session_env(configuration, host, port, modules=None):
+    """Return (before,after,paths) the environment set_env creates for a session
+
+    paths are the PATH like variables set_env wrote. os.environ is restored
+    afterwards, only sys.path keeps the python paths of the modules, which
+    the readiness probes need for omniORB.
+    """
+    saved = dict(os.environ)
+    try:
+        setenv.set_env_omniorb(host,port)
+        before = dict(os.environ)
+        paths = setenv.set_env(configuration,modules=modules)
+        return before,dict(os.environ),paths
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+class Session(object):
+
+    def __init__(self, config, host, port, modules, services):
+        self.config = config
+        self.host = host
+        self.port = int(port)
+        self.key = '{0}:{1}'.format(host,self.port)
+        with open(config,'r') as store:
+            self.configuration = json.load(store)
+        self.modules = modules or list(self.configuration['modules'].keys())
+        self.services = services
+        self.env = None
+        self.state = STARTING
+        self.reason = None
+        self.started = time.time()
+        self.names = []
+        self.rmfiles = []
+
+    def process_name(self, name):
+        return '{0}/{1}'.format(self.key,name)
+
+
+class DaemonSupervisor(Supervisor):
+    """Exits only end the session they belong to, not the whole loop"""
+
+    def __init__(self, on_session_exit):
+        Supervisor.__init__(self)
+        self.on_session_exit = on_session_exit
+
+    def on_exit(self, name, proc):
+        if not self.schedule_restart(name,proc):
+            self.on_session_exit(name,proc)
+
+
+class Daemon(object):
+    """Run the sessions of many launch_session calls in one event loop
+
+    build is called with a Session and returns (graph,policies), the
+    ServiceGraph of its services and the restart policies by service name.
+    Sessions are started one after another from the loop, which keeps
+    supervising the running ones and serving requests meanwhile. Every session
+    gets the environment set_env creates for it passed to its processes, the
+    daemon's own environment stays untouched.
+    """
+
+    def __init__(self, build, socketpath=None, shutdown_timeout=10.,
+                 cache_path=None):
+        self.build = build
+        self.socketpath = socketpath or default_socket()
+        self.shutdown_timeout = float(shutdown_timeout)
+        self.cache_path = cache_path
+        self.supervisor = DaemonSupervisor(self.session_exited)
+        self.sessions = {}
+        self.queue = deque()
+        self.server = None
+        self._clients = {}
+
+    # control socket
+
+    def listen(self):
+        if os.path.exists(self.socketpath):
+            # refuse to steal the socket of a running daemon
+            probe = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socketpath)
+            except socket.error:
+                os.remove(self.socketpath)
+            else:
+                raise RuntimeError('a daemon is already listening on {0}'.format(
+                    self.socketpath))
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.server.bind(self.socketpath)
+        os.chmod(self.socketpath,0o600)
+        self.server.listen(16)
+        self.server.setblocking(False)
+        self.supervisor.add_reader(self.server.fileno(),self._accept)
+
+    def _accept(self, fd, flags):
+        try:
+            conn,addr = self.server.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN,errno.EINTR):
+                return
+            raise
+        conn.setblocking(False)
+        self._clients[conn.fileno()] = [conn,b'']
+        self.supervisor.add_reader(conn.fileno(),self._read)
+
+    def _read(self, fd, flags):
+        conn,data = self._clients[fd]
+        try:
+            chunk = conn.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN,errno.EINTR):
+                return
+            chunk = b''
+        data += chunk
+        self._clients[fd][1] = data
+        if chunk and b'\n' not in data:
+            return
+        self.supervisor.remove_reader(fd)
+        del self._clients[fd]
+        try:
+            response = self.handle(json.loads(data.split(b'\n')[0].decode('utf-8')))
+        except Exception as e:
+            response = {'ok':False,'error':str(e)}
+        try:
+            conn.setblocking(True)
+            conn.settimeout(5.)
+            conn.sendall((json.dumps(response)+'\n').encode('utf-8'))
+        except socket.error as e:
+            logger.warning('failed to answer a request: {0}'.format(e))
+        finally:
+            conn.close()
+
+    def handle(self, req):
+        command = req.get('command')
+        if command == 'start':
+            return self.start(req['config'],req['host'],req['port'],
+                              req.get('modules'),req.get('services',[]))
+        elif command == 'stop':
+            return self.stop(self._session(req['session']).key)
+        elif command == 'list':
+            return {'ok':True,'sessions':[
+                self.describe(x) for x in sorted(self.sessions)]}
+        elif command == 'inspect':
+            return self.describe(self._session(req['session']).key,
+                                 output=True)
+        raise ValueError('unknown command {0}'.format(command))
+
+    def _session(self, key):
+        if key not in self.sessions:
+            raise ValueError('no session {0}'.format(key))
+        return self.sessions[key]
+
+    # sessions
+
+    def start(self, config, host, port, modules=None, services=()):
+        key = '{0}:{1}'.format(host,int(port))
+        old = self.sessions.get(key)
+        if old is not None and old.state not in (STOPPED,FAILED):
+            raise ValueError('session {0} is {1}'.format(key,old.state))
+        session = Session(os.path.abspath(config),host,port,modules,
+                          list(services))
+        self.sessions[key] = session
+        self.queue.append(session)
+        logger.info('queued session {0}'.format(key))
+        return self.describe(key)
+
+    def _launch(self, session):
+        """Start the services of a session, runs the loop meanwhile"""
+        supervisor = self.supervisor
+
+        def started(name,proc,rmf):
+            session.rmfiles.extend(rmf)
+            session.names.append(name)
+            supervisor.add(session.process_name(name),proc)
+
+        def idle(timeout):
+            supervisor.run_once(timeout)
+            if supervisor.reason is not None:
+                raise ShutdownRequested(supervisor.reason)
+            if session.state != STARTING:
+                raise ShutdownRequested(session.reason or session.state)
+
+        def respawn(name):
+            proc,rmf = graph.spawn(name)
+            session.rmfiles.extend(rmf)
+            return proc
+
+        logger.info('starting session {0}'.format(session.key))
+        try:
+            before,session.env,paths = session_env(
+                session.configuration,session.host,session.port,
+                session.modules)
+            graph,policies = self.build(session)
+            for name,policy in policies.items():
+                supervisor.set_restart(
+                    session.process_name(name),
+                    lambda name=name: respawn(name),
+                    RestartPolicy.from_config(policy))
+            graph.start(started=started,idle=idle,timeout=0.02)
+            if self.cache_path is not None:
+                # connect_session works with the sessions of the daemon too
+                cachefile = self.cache_path(session.host,session.port)
+                with open(cachefile,'w') as store:
+                    json.dump(session.configuration,store)
+                session.rmfiles.append(cachefile)
+                envfile = self.cache_path(session.host,session.port,'.env.json')
+                setenv.save_env_snapshot(
+                    envfile,session.configuration,before,session.env,paths)
+                session.rmfiles.append(envfile)
+        except Exception as e:
+            if supervisor.reason is not None or session.state != STARTING:
+                return
+            logger.warning('session {0} failed to start: {1}'.format(
+                session.key,e))
+            self.stop(session.key,reason='startup failed: {0}'.format(e))
+            return
+        if session.state == STARTING:
+            session.state = RUNNING
+            logger.info('session {0} running'.format(session.key))
+
+    def session_exited(self, name, proc):
+        key,service = name.split('/',1)
+        session = self.sessions.get(key)
+        if session is None or session.state in (STOPPING,STOPPED,FAILED):
+            return
+        self.stop(key,reason='{0} {1}'.format(
+            service,describe_status(proc.returncode)))
+
+    def _processes(self, session):
+        names = set(session.process_name(x) for x in session.names)
+        return [x for x in self.supervisor.processes if x[0] in names]
+
+    def stop(self, key, reason=None):
+        """Terminate the processes of the session without blocking the loop"""
+        session = self._session(key)
+        if session.state in (STOPPING,STOPPED,FAILED):
+            return self.describe(key)
+        if session in self.queue:
+            self.queue.remove(session)
+        session.state = STOPPING
+        session.reason = reason or 'stopped on request'
+        logger.info('stopping session {0}: {1}'.format(key,session.reason))
+        for name in session.names:
+            # no restarts while going down
+            self.supervisor.cancel_restart(session.process_name(name))
+
+        def done():
+            for name,proc in self._processes(session):
+                self.supervisor.discard(name)
+            removeFiles(session.rmfiles)
+            session.state = STOPPED if reason is None else FAILED
+            logger.info('session {0} {1}'.format(key,session.state))
+        self.supervisor.terminate_later(
+            self._processes(session),timeout=self.shutdown_timeout,done=done)
+        return self.describe(key)
+
+    def describe(self, key, output=False):
+        session = self.sessions[key]
+        result = {
+            'ok':True,
+            'session':key,
+            'config':session.config,
+            'state':session.state,
+            'reason':session.reason,
+            'started':session.started,
+            'modules':session.modules,
+        }
+        if output:
+            drain = self.supervisor.drain
+            services = []
+            for name,proc in self._processes(session):
+                services.append({
+                    'name':name.split('/',1)[1],
+                    'pid':proc.pid,
+                    'status':describe_status(proc.poll()),
+                    'stdout':drain.output(name,'stdout')[-2048:].decode('utf-8','replace'),
+                    'stderr':drain.output(name,'stderr')[-2048:].decode('utf-8','replace'),
+                })
+            result['services'] = services
+        return result
+
+    def run(self):
+        supervisor = self.supervisor
+        self.listen()
+        supervisor.install()
+        logger.info('daemon listening on {0}'.format(self.socketpath))
+        try:
+            supervisor.reap()
+            while supervisor.reason is None:
+                if self.queue:
+                    self._launch(self.queue.popleft())
+                else:
+                    supervisor.run_once()
+            logger.info('daemon stopped: {0}'.format(supervisor.reason))
+        finally:
+            supervisor.uninstall()
+            supervisor.remove_reader(self.server.fileno())
+            self.server.close()
+            os.remove(self.socketpath)
+            for fd,(conn,data) in list(self._clients.items()):
+                conn.close()
+            # all sessions at once, like the clean up of launch_session
+            terminate(supervisor.processes,timeout=self.shutdown_timeout)
+            for session in self.sessions.values():
+                if session.state not in (STOPPED,FAILED):
+                    removeFiles(session.rmfiles)
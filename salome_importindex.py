@@ -0,0 +1,152 @@
+#  -*- coding: iso-8859-1 -*-
+# meta path finder answering top level imports from an index of the python
+# directories of the modules, built at config time by setenv.build_import_index
+#
+# the module only depends on the standard library, it is copied as
+# sitecustomize.py next to the index, so every python process of a session
+# with that directory on its PYTHONPATH installs the finder at startup
+
+import os
+import sys
+import json
+
+# imported here, imports from within the finder would recurse into it
+try:
+    from importlib.machinery import PathFinder
+except ImportError:
+    # python 2
+    PathFinder = None
+    import imp
+
+# file endings of importable top level modules
+SUFFIXES = ('.py','.pyc','.pyo','.so','.pyd')
+
+
+def top_level_names(directory):
+    """Dict of the importable top level names in directory
+
+    Maps the name to True for modules and regular packages and to False for
+    directories which can only be namespace package portions.
+    """
+    names = {}
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return names
+    for entry in entries:
+        path = os.path.join(directory,entry)
+        if os.path.isdir(path):
+            if '.' in entry:
+                continue
+            regular = any(os.path.isfile(os.path.join(path,'__init__'+x))
+                          for x in ('.py','.pyc','.pyo'))
+            names[entry] = names.get(entry,False) or regular
+        elif entry.endswith(SUFFIXES):
+            names[entry.split('.',1)[0]] = True
+    return names
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class IndexFinder(object):
+    """Find top level modules in the indexed directories without a scan
+
+    A name in the index is only looked for in the directories having it, any
+    other name only in the directories of sys.path which are not indexed.
+    Everything below the top level is found through the package __path__ as
+    usual.
+    """
+
+    def __init__(self, index):
+        rank = dict((x,i) for i,x in reversed(list(enumerate(sys.path))))
+        self.dirs = set(index['dirs'])
+        # in the order of sys.path, which may differ from the one at build time
+        self.modules = dict(
+            (name,sorted([x for x in dirs if x in rank],key=rank.get))
+            for name,dirs in index['modules'].items())
+
+    def _path(self, fullname):
+        if fullname in self.modules:
+            return self.modules[fullname]
+        return [x for x in sys.path if x not in self.dirs]
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None or '.' in fullname:
+            return None
+        return PathFinder.find_spec(fullname,self._path(fullname),target)
+
+    def find_module(self, fullname, path=None):
+        # python 2
+        if path is not None or '.' in fullname:
+            return None
+        try:
+            found = imp.find_module(fullname,self._path(fullname))
+        except ImportError:
+            return None
+        return _Loader(found)
+
+
+class _Loader(object):
+
+    def __init__(self, found):
+        self.found = found
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        f = self.found[0]
+        try:
+            return imp.load_module(fullname,*self.found)
+        finally:
+            if f is not None:
+                f.close()
+
+
+def load(indexfile):
+    """The index, None if it is missing or one of its directories changed"""
+    try:
+        with open(indexfile,'r') as store:
+            index = json.load(store)
+    except (IOError,ValueError):
+        return None
+    for directory,mtime in index['mtimes'].items():
+        if _mtime(directory) != mtime:
+            return None
+    return index
+
+def install(indexfile):
+    """Put the finder in front of the path based import, True if it is used"""
+    for finder in sys.meta_path:
+        if isinstance(finder,IndexFinder) or \
+           type(finder).__name__ == 'IndexFinder':
+            return True
+    index = load(indexfile)
+    if index is None:
+        return False
+    finder = IndexFinder(index)
+    position = 0
+    for i,item in enumerate(sys.meta_path):
+        if getattr(item,'__name__',None) == 'PathFinder':
+            position = i
+            break
+    sys.meta_path.insert(position,finder)
+    return True
+
+if __name__ == 'sitecustomize':
+    here = os.path.dirname(os.path.abspath(__file__))
+    install(os.path.join(here,'index.json'))
+    # a sitecustomize further down the path still runs
+    this = sys.modules.pop('sitecustomize')
+    saved = sys.path[:]
+    sys.path[:] = [x for x in sys.path if os.path.abspath(x or '.') != here]
+    try:
+        import sitecustomize
+    except ImportError:
+        pass
+    finally:
+        sys.path[:] = saved
+        sys.modules.setdefault('sitecustomize',this)
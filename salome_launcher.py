@@ -4,17 +4,13 @@ import sys
 import shutil
 import subprocess
 import socket
-import select
 import logging
 import datetime
 import setenv
+from salome_utils import getLauncherCacheDir,getSessionCacheFile,removeFiles
+from salome_profile import timeline
 import time
-from omniORB import CORBA
 from opster import command,dispatch
-import CosNaming
-import glob
-import json
-import signal
 import json
 import tempfile
 import traceback
@@ -28,6 +24,26 @@ logger.addHandler(stream_handler)
 
 HOST = '127.0.0.1'
 LOGFILE = '/home/martin/mytestlogfile.log'
+# names of the ior files of notifd in the runtime dir of the session
+CHANNEL_IOR = 'rdichan.ior'
+FACTORY_IOR = 'rdifact.ior'
+# ports tried with --port auto unless the config has a port_range
+DEFAULT_PORT_RANGE = '2810-2899'
+
+# services which are restarted if they crash, unless configured otherwise in
+# the services section of the config or with --restart
+DEFAULT_RESTART = {
+    'salomeds':'on-failure',
+    'connection_manager':'on-failure',
+}
+
+# names the servers register in the NameService once they are usable
+NS_NAMES = {
+    'salomeds':'/myStudyManager',
+    'launcher':'/SalomeLauncher',
+    'session':'/Kernel/Session',
+    'connection_manager':'/ConnectionManager',
+}
 
 def test_port(host,port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -37,6 +53,21 @@ def test_port(host,port):
     sock.close()
     return True
 
+def spawn(args,limits=None,**kwargs):
+    """Start a service in its own process group with its output piped
+
+    limits is a dict with cpus, nice and rlimits applied to the child, see
+    salome_limits.prepare
+    """
+    import salome_limits
+    kwargs.setdefault('stdout',subprocess.PIPE)
+    kwargs.setdefault('stderr',subprocess.PIPE)
+    # the own group allows to reach grand children like gdb, xterm or the
+    # containers on shut down
+    args,preexec = salome_limits.prepare(args,limits)
+    kwargs.setdefault('preexec_fn',preexec)
+    return subprocess.Popen(args,**kwargs)
+
 def save_config(config,configpath):
     with open(configpath,'w') as store:
         json.dump(config,store,sort_keys=True, indent=4)
@@ -47,9 +78,11 @@ def read_config(configpath):
     return config
 
 
-def start_naming_service(host,port):
+def start_naming_service(host,port,limits=None,env=None,rundir=None):
     test_port(host,port)
-    logdir = '/tmp/logs/omniNames_{0}'.format(port)
+    if rundir is None:
+        rundir = setenv.make_runtime_dir(host,port)
+    logdir = os.path.join(rundir,'omniNames')
     try:
         shutil.rmtree(logdir)
     except:
@@ -59,44 +92,54 @@ def start_naming_service(host,port):
     # in the cfg it is important that the line
     # InitRef = NameService=corbaname::mortbauer:2815
     # points to the correct host and port
-    omninames = subprocess.Popen([
+    omninames = spawn([
         'omniNames',
         '-start',str(port),
         '-logdir', logdir,
         '-errlog', os.path.join(logdir,'omniNameErrors.log'),
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    ],limits=limits,env=env)
 
-    conffile = os.environ['OMNIORB_CONFIG']
+    conffile = (env or os.environ)['OMNIORB_CONFIG']
+    write_omniorb_config(conffile,'corbaname::{0}:{1}'.format(host,port))
+    return omninames,(conffile,logdir)
+
+def write_omniorb_config(conffile,nameservice):
     # make sure the directory exists
     if not os.path.isdir(os.path.split(conffile)[0]):
         os.makedirs(os.path.split(conffile)[0])
 
     with open(conffile,'w') as f:
-        f.write('InitRef = NameService=corbaname::{0}:{1}\n'.format(host,port))
+        f.write('InitRef = NameService={0}\n'.format(nameservice))
         f.write('giopMaxMsgSize = 2097152000 # 2 GBytes\n')
         f.write('traceLevel = 0 # critical errors only\n')
-    return omninames,(conffile,logdir)
 
-def start_notification_service(channelfile):
-    notifd = subprocess.Popen([
+def start_notification_service(channelfile,rundir,limits=None,env=None):
+    factory_ior = os.path.join(rundir,FACTORY_IOR)
+    channel_ior = os.path.join(rundir,CHANNEL_IOR)
+    # a stale ior file would make the readiness probe pass too early
+    for path in (factory_ior,channel_ior):
+        if os.path.isfile(path):
+            os.remove(path)
+    notifd = spawn([
         'notifd','-c', channelfile,
-        '-DFactoryIORFileName=/tmp/rdifact.ior',
-        '-DChannelIORFileName=/tmp/rdichan.ior',
-        '-DReportLogFile=/tmp/notifd.report',
-        '-DDebugLogFile=/tmp/notifd.debug',
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        '-DFactoryIORFileName={0}'.format(factory_ior),
+        '-DChannelIORFileName={0}'.format(channel_ior),
+        '-DReportLogFile={0}'.format(os.path.join(rundir,'notifd.report')),
+        '-DDebugLogFile={0}'.format(os.path.join(rundir,'notifd.debug')),
+    ],limits=limits,env=env)
     return notifd
 
-def start_salome_launcher_service(modules,catalogs,rootsdir):
-    salome_launcher_service = subprocess.Popen([
+def start_salome_launcher_service(modules,catalogs,rootsdir,limits=None,env=None):
+    salome_launcher_service = spawn([
         os.path.join(rootsdir['KERNEL']['bin'],'SALOME_LauncherServer'),
         '--with', 'Registry', '(', '--salome_session', 'theSession', ')',
         '--with', 'ModuleCatalog', '(', '-common', '::'.join(catalogs), ')',
         '--with', 'SALOMEDS', '(', ')', '--with', 'Container', '(', 'FactoryServer', ')',
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    ],limits=limits,env=env,bufsize=1)
     return salome_launcher_service
 
-def start_salome_session_server(modules,catalogs,rootsdir,services=[],gdb=False):
+def start_salome_session_server(modules,catalogs,rootsdir,services=[],gdb=False,
+                                limits=None,env=None,rundir=None):
     args = [
         os.path.join(rootsdir['GUI']['bin'],'SALOME_Session_Server'),
         '--with', 'Registry', '(', '--salome_session', 'theSession', ')',
@@ -111,189 +154,501 @@ def start_salome_session_server(modules,catalogs,rootsdir,services=[],gdb=False)
     if gdb:
         # write a script which gets executed to also set the path variables
         # correct
-        f = tempfile.NamedTemporaryFile(delete=False)
+        f = tempfile.NamedTemporaryFile(delete=False,dir=rundir)
         f.write('export LD_LIBRARY_PATH="{0}"\n'.format(
-            os.getenv('LD_LIBRARY_PATH')))
+            (env or os.environ).get('LD_LIBRARY_PATH')))
         f.write(args[0])
         f.write(' \'{0}\''.format(' '.join(args[1:])))
         args = ['xterm','-e','gdb','-ex','r','--args','bash',f.name]
         rmfiles.append(f.name)
-    salome_session_server = subprocess.Popen(
-        args,stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    salome_session_server = spawn(args,limits=limits,env=env,bufsize=1)
     return salome_session_server,rmfiles
 
-def start_salome_connection_manager(modules,catalogs,rootsdir):
-    salome_connection_manager = subprocess.Popen([
+def start_salome_connection_manager(modules,catalogs,rootsdir,limits=None,
+                                    env=None):
+    salome_connection_manager = spawn([
         os.path.join(rootsdir['KERNEL']['bin'],'SALOME_ConnectionManagerServer'),
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    ],limits=limits,env=env,bufsize=1)
     return salome_connection_manager
 
-def start_salome_logger_server(rootsdir,logfile):
-    salome_logger_server = subprocess.Popen([
+def start_salome_logger_server(rootsdir,logfile,limits=None,env=None):
+    salome_logger_server = spawn([
         os.path.join(rootsdir['KERNEL']['bin'],'SALOME_Logger_Server'),logfile,
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    ],limits=limits,env=env,bufsize=1)
     return salome_logger_server
 
-def start_salome_session_loader(rootsdir):
-    p = subprocess.Popen([os.path.join(
+def start_salome_session_loader(rootsdir,limits=None,env=None):
+    p = spawn([os.path.join(
         rootsdir['KERNEL']['bin'],'SALOME_Session_Loader'),'GUI','PY',
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    ],limits=limits,env=env,bufsize=1)
     return p
 
-def start_salomeds_server(rootsdir):
-    p = subprocess.Popen([os.path.join(
+def start_salomeds_server(rootsdir,limits=None,env=None):
+    p = spawn([os.path.join(
         rootsdir['KERNEL']['bin'],'SALOMEDS_Server'),
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    ],limits=limits,env=env,bufsize=1)
     return p
 
-def start_salome_container_server(rootsdir):
-    p = subprocess.Popen([os.path.join(
+def start_salome_container_server(rootsdir,limits=None,env=None):
+    p = spawn([os.path.join(
         rootsdir['KERNEL']['bin'],'SALOME_Container'),
         'FactoryServer','-ORBInitRef','NameService=corbaname::localhost',
-    ],stdout=subprocess.PIPE,stderr=subprocess.PIPE,bufsize=1)
+    ],limits=limits,env=env,bufsize=1)
     return p
 
 
+def session_graph(configuration,host,port,modules,services,gdb=False,
+                  limits=None,timeout=60.,env=None,nameservice=None):
+    """ServiceGraph starting the services of a session
+
+    limits is a function returning the limits of a service by its name, env
+    the environment of the services, by default they inherit os.environ. The
+    runtime files go to setenv.runtime_dir(host,port), create it with
+    setenv.make_runtime_dir before and remove it afterwards.
+    With nameservice, the corbaname url of a naming context in a shared
+    naming service, the session starts no naming and notification services.
+    """
+    from salome_startup import ServiceGraph,probe,port_probe,file_probe,name_probe
+    if limits is None:
+        limits = lambda name: None
+    channelfile = os.path.join(
+        configuration['modules']['KERNEL']['resources'],'channel.cfg')
+    with timeline.phase('catalogs'):
+        catalogs = setenv.prepare_catalogs(configuration['modules'],modules)
+    shared = nameservice is not None
+    if not shared:
+        nameservice = 'corbaname::{0}:{1}'.format(host,port)
+    rundir = setenv.runtime_dir(host,port)
+
+    def ready(name,*checks):
+        return probe(*checks,timeout=timeout,what=name)
+
+    def registered(name):
+        return ready(name,name_probe(NS_NAMES[name],nameservice))
+
+    # everything waits on the naming service, the other servers are
+    # independent of each other and get started at once
+    graph = ServiceGraph()
+    naming = [] if shared else ['naming']
+    if not shared:
+        graph.add('naming',
+                  lambda: start_naming_service(
+                      host,port,limits=limits('naming'),env=env,rundir=rundir),
+                  ready=ready('naming',port_probe(host,port)))
+        graph.add('notification',
+                  lambda: start_notification_service(
+                      channelfile,rundir,limits=limits('notification'),env=env),
+                  requires=naming,
+                  ready=ready('notification',
+                              file_probe(os.path.join(rundir,CHANNEL_IOR))))
+    graph.add('salomeds',
+              lambda: start_salomeds_server(
+                  configuration['modules'],limits=limits('salomeds'),env=env),
+              requires=naming,ready=registered('salomeds'))
+    graph.add('launcher',
+              lambda: start_salome_launcher_service(
+                  modules,catalogs,configuration['modules'],
+                  limits=limits('launcher'),env=env),
+              requires=naming,ready=registered('launcher'))
+    graph.add('session',
+              lambda: start_salome_session_server(
+                  modules,catalogs,configuration['modules'],
+                  services=services,gdb=gdb,limits=limits('session'),env=env,
+                  rundir=rundir),
+              requires=naming+['launcher'],ready=registered('session'))
+    graph.add('connection_manager',
+              lambda: start_salome_connection_manager(
+                  modules,catalogs,configuration['modules'],
+                  limits=limits('connection_manager'),env=env),
+              requires=naming,ready=registered('connection_manager'))
+    return graph
+
+def restart_policies(configuration,restart=''):
+    """Restart policy of every service which gets restarted
+
+    the config may give a name or a dict with the arguments of RestartPolicy,
+    restart is a string like salomeds=always,connection_manager=never and wins
+    """
+    policies = dict(DEFAULT_RESTART)
+    for name,conf in configuration.get('services',{}).items():
+        if 'restart' in conf:
+            policies[name] = conf['restart']
+    for item in [x for x in restart.split(',') if x]:
+        name,policy = item.split('=',1)
+        policies[name] = policy
+    for name,policy in list(policies.items()):
+        if isinstance(policy,dict):
+            policy = policy.get('policy','never')
+        if policy == 'never':
+            # nothing to restart, fine for any service
+            del policies[name]
+        elif name not in NS_NAMES:
+            # a restarted server registers itself again in the running naming
+            # service, the naming service itself can't be restarted
+            raise ValueError('{0} can not be restarted'.format(name))
+    return policies
+
+
 @command(usage='PATH_TO_MODULES OUTPUTFILEPATH')
 def create_and_save_config_template(modules_path,config_path,
-                                    prereq_paths=('',[],'paths to extra prerequisites')):
-    save_config(setenv.create_config_template(modules_path,prereq_paths),config_path)
+                                    prereq_paths=('',[],'paths to extra prerequisites'),
+                                    update=('u',False,'rescan only what changed and keep the hand edits of the existing config'),
+                                    lib_farm=('',False,'symlink the libraries of all modules and prerequisites into one directory <config>.lib used instead of them, kept with --update'),
+                                    import_index=('',False,'index the top level python modules of all modules in <config>.pyindex to find them without searching the PYTHONPATH, kept with --update')):
+    # the state of the scanned directories, allows to update incrementally
+    indexpath = '{0}.index'.format(config_path)
+    index = {}
+    if update and os.path.isfile(indexpath):
+        index = read_config(indexpath)
+    previous = index.get('generated',{})
+    config = setenv.create_config_template(modules_path,prereq_paths,index=index)
+    current = None
+    if update and os.path.isfile(config_path):
+        current = read_config(config_path)
+    if lib_farm or (current is not None and 'lib_farm' in current):
+        config['lib_farm'] = setenv.build_lib_farm(
+            config,'{0}.lib'.format(os.path.abspath(config_path)),index=index)
+    if import_index or (current is not None and 'import_index' in current):
+        config['import_index'] = setenv.build_import_index(
+            config,'{0}.pyindex'.format(os.path.abspath(config_path)),index=index)
+    index['generated'] = config
+    if current is not None:
+        config = setenv.merge_config(current,previous,config)
+    save_config(config,config_path)
+    save_config(index,indexpath)
 
 @command()
 def launch_session(config,
                    host=('h',HOST,'specify the host machine'),
-                   port=('p',2815,'specify the port'),
+                   port=('p','2815','specify the port, auto picks a free one of --port-range'),
+                   port_range=('','','ports for --port auto, e.g. 2810-2899, defaults to the port_range of the config or {0}'.format(DEFAULT_PORT_RANGE)),
                    modules=('m','','specify a list of modules to load'),
                    quiet=('',False,'don\'t print any error messages from salome'),
                    nogui=('',False,'don\'launch gui'),
                    services=('s','CPP,GUI,SPLASH','specify a list of services to load (CPP,GUI,SPLAH)'),
                    gdb=('',False,'debug with gdb'),
+                   timeout=('t',60,'seconds to wait for each service to get ready'),
+                   profile_startup=('',False,'record a timeline of the startup'),
+                   shutdown_timeout=('',10,'seconds to wait for the services to terminate before killing them'),
+                   restart=('','','restart policies, e.g. salomeds=always,connection_manager=never'),
+                   metrics_interval=('',0,'sample the resource usage of the services every that many seconds'),
+                   cpus=('','','cpu list the services are bound to, e.g. 0-3,8'),
+                   nice=('',0,'nice level of the services'),
+                   rlimits=('','','resource limits of the services, e.g. as=8000000000,nofile=4096,core=0'),
+                   numa=('',False,'bind the services to the numa node with the fewest sessions'),
+                   shared_naming=('','','HOST:PORT of a naming service started with naming_serve, the session uses a naming context in it instead of own naming and notification services'),
                    ):
-    configuration = read_config(config)
+    # the session machinery is only needed here, keep the other commands fast
+    from salome_startup import PortReservation
+    from salome_limits import merge_limits,place_session,format_cpus
+    from salome_metrics import MetricsRecorder
+    from salome_supervisor import Supervisor,ShutdownRequested,RestartPolicy,\
+            describe_status,terminate
+    if profile_startup:
+        timeline.enable()
+    with timeline.phase('read_config'):
+        configuration = read_config(config)
     # by default load all modules
+    # with a subset of modules, the environment only covers them and the
+    # modules they require
+    subset = None
     if not modules:
         modules = configuration['modules'].keys()
     else:
         modules = [x.upper() for x in modules.split(',')]
+        subset = modules
 
     # by default load all services
     services = [x.upper() for x in services.split(',')]
     if nogui:
         services = [x for x in services if x != 'GUI']
 
+    # the reservation keeps concurrent launches off the port until the
+    # naming service listens on it
+    reservation = None
+    auto_port = port == 'auto'
+    if auto_port:
+        port_range = port_range or configuration.get(
+            'port_range',DEFAULT_PORT_RANGE)
+        reservation = PortReservation(host,port_range,getLauncherCacheDir())
+        port = reservation.port
+        print('using port {0}'.format(port))
+    elif shared_naming:
+        # nothing listens on the port of a session in a shared naming service,
+        # the reservation alone keeps a second launch off its naming context,
+        # runtime dir and cache entry
+        reservation = PortReservation(host,port,getLauncherCacheDir())
+    port = int(port)
+
     # set up the environment
     setenv.set_env_omniorb(host,port)
-    setenv.set_env(configuration)
+    env_before = dict(os.environ)
+    with timeline.phase('set_env'):
+        path_variables = setenv.set_env(configuration,modules=subset)
 
-    channelfile = os.path.join(
-        configuration['modules']['KERNEL']['resources'],'channel.cfg')
-
-    catalogs = [v['catalog'] for v in configuration['modules'].values()]
-    processes = []
+    # iors, logs, the omniORB cfg and the gdb script, all removed at once
+    rundir = setenv.make_runtime_dir(host,port)
     rmfiles = []
+    supervisor = Supervisor(on_output=timeline.first_output)
+    processes = supervisor.processes
+    drain = supervisor.drain
 
     def clean_up():
-        for i,proc in enumerate(processes):
-            if proc.poll() == None:
-                proc.kill()
-                proc.wait()
-                if not quiet:
-                    err = proc.stderr.read()
-                    if err:
-                        print(err)
-        for path in rmfiles:
-            if os.path.isfile(path):
-                os.remove(path)
-            elif os.path.isdir(path):
-                shutil.rmtree(path)
-
-    def signal_handler(signum=None, frame=None):
-        ## seems useless, but maybe will need it later so leave it here anyways
-        clean_up()
-
-    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
-        signal.signal(sig, signal_handler)
-    try:
-        omninames,(confile,logdir) = start_naming_service(host,port)
-        processes = [omninames]
-        rmfiles = [confile,logdir]
-
-        processes.append(start_notification_service(channelfile))
-        #processes.append(start_salome_session_loader(configuration['modules']))
-        processes.append(start_salomeds_server(configuration['modules']))
-        #processes.append(start_salome_container_server(configuration['modules']))
-        #salome_logger = start_salome_logger_server(
-            #MODULES,LOGFILE)
-
-        processes.append(
-            start_salome_launcher_service(
-                modules,catalogs,configuration['modules']))
-        # wait
-        import orbmodule
-        clt = orbmodule.client()
-        #clt.waitNS('/myStudyManager')
-        ssm,rmf = start_salome_session_server(
-            modules,catalogs,configuration['modules'],services=services,gdb=gdb)
-        processes.append(ssm)
+        terminate(processes,timeout=float(shutdown_timeout),
+                  background=lambda: removeFiles(rmfiles+[rundir]))
+        drain.flush()
+        if not quiet:
+            for name,proc in processes:
+                err = drain.output(name,'stderr')
+                if err:
+                    print(err)
+
+    def started(name,proc,rmf):
         rmfiles.extend(rmf)
-        processes.append(
-            start_salome_connection_manager(
-                modules,catalogs,configuration['modules']))
+        timeline.spawned(name,proc)
+        supervisor.add(name,proc)
+
+    def idle(timeout):
+        # handle output, signals and exits while waiting for the services
+        supervisor.run_once(timeout)
+        if supervisor.reason is not None:
+            raise ShutdownRequested(supervisor.reason)
+
+    # placement and limits, the numa node is the default, the services
+    # section of the config is more specific and the command line wins
+    placement = {}
+    if numa:
+        placementfile,node_cpus = place_session(
+            getLauncherCacheDir(),'{0}:{1}'.format(host,port))
+        rmfiles.append(placementfile)
+        placement['cpus'] = format_cpus(node_cpus)
+        logger.info('placing session on cpus {0}'.format(placement['cpus']))
+    cli_limits = {'cpus':cpus,'nice':int(nice) or None,'rlimits':rlimits}
+
+    def limits(name):
+        return merge_limits(
+            placement,configuration.get('services',{}).get(name,{}),cli_limits)
+
+    # the servers register in a naming context of the shared naming service
+    nameservice = None
+    if shared_naming:
+        from salome_naming import context_name
+        nshost,nsport = shared_naming.rsplit(':',1)
+        context = context_name(host,port)
+        nameservice = 'corbaname::{0}:{1}#{2}'.format(nshost,nsport,context)
+
+    graph = session_graph(configuration,host,port,modules,services,gdb=gdb,
+                          limits=limits,timeout=float(timeout),
+                          nameservice=nameservice)
+    policies = restart_policies(configuration,restart)
+
+    def respawn(name):
+        proc,rmf = graph.spawn(name)
+        rmfiles.extend(rmf)
+        return proc
 
-        import Engines
-        import SALOME
-        import SALOMEDS
-        import SALOME_ModuleCatalog
-        import SALOME_Session_idl
+    for name,policy in policies.items():
+        supervisor.set_restart(name,lambda name=name: respawn(name),
+                               RestartPolicy.from_config(policy))
 
-        run = True
+    def on_ready(name):
+        timeline.ready(name)
+        # with a shared naming service nobody listens on the port, it stays
+        # reserved for the whole session
+        if name == 'naming' and reservation is not None:
+            reservation.release()
 
-        poller = select.epoll()
-        fds = {}
-        for proc in processes:
-            poller.register(proc.stdout, select.EPOLLHUP)
-            fds[proc.stdout.fileno()] = proc.stdout
+    supervisor.install()
+    try:
+        if nameservice is not None:
+            from salome_naming import create_session_context
+            with timeline.phase('naming context'):
+                create_session_context(nshost,nsport,context)
+            write_omniorb_config(os.environ['OMNIORB_CONFIG'],nameservice)
+        # drain the output while waiting, the pipes must never fill up
+        graph.start(started=started,on_ready=on_ready,
+                    idle=idle,timeout=0.02)
+
+        with timeline.phase('import Engines'):
+            import Engines
+        with timeline.phase('import SALOME'):
+            import SALOME
+        with timeline.phase('import SALOMEDS'):
+            import SALOMEDS
+        import SALOME_ModuleCatalog
+        import SALOME_Session_idl
 
         # save the config to the cache to easy connect to it
-        cachedir= os.path.join(setenv.getCacheDir(),'salome_launcher')
-        # make sure it exists
-        if not os.path.isdir(cachedir):
-            os.makedirs(cachedir)
-        cachefile = os.path.join(cachedir,'{0}:{1}.json'.format(host,port))
+        cachefile = getSessionCacheFile(host,port)
+        entry = dict(configuration)
+        entry['session'] = {
+            'host':host,'port':port,
+            'port_range':port_range if auto_port else None,
+            'auto_port':auto_port,'pid':os.getpid(),
+            'shared_naming':shared_naming or None}
         with open(cachefile,'w') as store:
-            json.dump(configuration,store)
+            json.dump(entry,store)
         rmfiles.append(cachefile)
+        # the resolved environment, connect_session applies it directly
+        envfile = getSessionCacheFile(host,port,'.env.json')
+        setenv.save_env_snapshot(envfile,configuration,env_before,
+                                 paths=path_variables)
+        rmfiles.append(envfile)
+
+        if float(metrics_interval) > 0:
+            recorder = MetricsRecorder(
+                supervisor,'{0}:{1}'.format(host,port),
+                getSessionCacheFile(host,port,'.prom'),
+                getSessionCacheFile(host,port,'.metrics.json'),
+                interval=float(metrics_interval))
+            rmfiles.extend([recorder.promfile,recorder.jsonfile])
+            recorder.start()
+
+        if timeline.enabled:
+            # kept after the session ended, so no rmfile
+            timelinefile = getSessionCacheFile(host,port,'.startup.json')
+            timeline.save(timelinefile)
+            print(timeline.waterfall())
+            print('startup timeline saved to {0}'.format(timelinefile))
 
         print('salome running on {0}:{1}'.format(host,port))
 
-        while run:
-            try:
-                for fd,flags in poller.poll(timeout=1):
-                    run = False
-            except KeyboardInterrupt:
-                print("received interrupt, shutting done")
-            except IOError as e:
-                logger.warn('IOError: "{0}", continuing'.format(e))
-
-
+        reason = supervisor.run()
+        print('salome on {0}:{1} stopped: {2}'.format(host,port,reason))
+    except ShutdownRequested as e:
+        print('salome startup aborted: {0}'.format(e))
     except Exception as e:
         print(traceback.format_exc())
         #print('sorry, couldn\'t launch because of: {0}'.format(e))
     finally:
+        if reservation is not None:
+            reservation.release()
+        supervisor.uninstall()
         clean_up()
+        for name,proc in processes:
+            logger.info('{0} (pid {1}) {2}'.format(
+                name,proc.pid,describe_status(proc.returncode)))
+        if nameservice is not None:
+            from salome_naming import remove_session_context
+            try:
+                remove_session_context(nshost,nsport,context)
+            except Exception as e:
+                logger.warning('failed to remove the naming context {0}: {1}'.format(
+                    context,e))
     return
 
+@command()
+def naming_serve(config,
+                 host=('h',HOST,'specify the host machine'),
+                 port=('p',2809,'specify the port'),
+                 timeout=('t',60,'seconds to wait for each service to get ready'),
+                 shutdown_timeout=('',10,'seconds to wait for the services to terminate before killing them')):
+    """run a naming and notification service shared by many sessions
+
+    launch sessions with --shared-naming HOST:PORT to use it, each of them
+    gets its own naming context, the notification channel is shared
+    """
+    from salome_startup import ServiceGraph,probe,port_probe,file_probe
+    from salome_supervisor import Supervisor,ShutdownRequested,terminate
+    configuration = read_config(config)
+    setenv.set_env_omniorb(host,port)
+    setenv.set_env(configuration)
+    rundir = setenv.make_runtime_dir(host,port)
+    channelfile = os.path.join(
+        configuration['modules']['KERNEL']['resources'],'channel.cfg')
+    graph = ServiceGraph()
+    graph.add('naming',lambda: start_naming_service(host,port,rundir=rundir),
+              ready=probe(port_probe(host,port),timeout=float(timeout),
+                          what='naming'))
+    graph.add('notification',
+              lambda: start_notification_service(channelfile,rundir),
+              requires=['naming'],
+              ready=probe(file_probe(os.path.join(rundir,CHANNEL_IOR)),
+                          timeout=float(timeout),what='notification'))
+    supervisor = Supervisor()
+
+    def idle(timeout):
+        supervisor.run_once(timeout)
+        if supervisor.reason is not None:
+            raise ShutdownRequested(supervisor.reason)
+
+    supervisor.install()
+    try:
+        graph.start(started=lambda name,proc,rmf: supervisor.add(name,proc),
+                    idle=idle,timeout=0.02)
+        print('shared naming service running on {0}:{1}'.format(host,port))
+        reason = supervisor.run()
+        print('shared naming service stopped: {0}'.format(reason))
+    except ShutdownRequested as e:
+        print('shared naming service startup aborted: {0}'.format(e))
+    finally:
+        supervisor.uninstall()
+        terminate(supervisor.processes,timeout=float(shutdown_timeout),
+                  background=lambda: removeFiles([rundir]))
+
+@command()
+def bench_imports(config,
+                  modules=('m','salome,smesh,geompy','python modules to import'),
+                  repeat=('r',3,'runs per module, the median is shown')):
+    """time the imports of python modules with and without the import index"""
+    configuration = read_config(config)
+    imports = configuration.get('import_index')
+    if not imports:
+        print('{0} has no import index, create it with --import-index'.format(config))
+        return False
+    setenv.set_env(configuration)
+    indexed = dict(os.environ)
+    plain = dict(os.environ)
+    plain['PYTHONPATH'] = os.pathsep.join(
+        x for x in plain.get('PYTHONPATH','').split(os.pathsep)
+        if x != imports['path'])
+    code = 'import time; t = time.time(); import {0}; print(time.time()-t)'
+
+    def run(name,env):
+        """(import,process) seconds, the medians of the runs, None on failure"""
+        times = []
+        for i in range(int(repeat)):
+            start = time.time()
+            p = subprocess.Popen([sys.executable,'-c',code.format(name)],env=env,
+                                 stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            out,err = p.communicate()
+            if p.returncode != 0:
+                logger.warning('import {0} failed:\n{1}'.format(
+                    name,err.decode('utf-8','replace')[-2048:]))
+                return None
+            times.append((float(out.decode('utf-8').split()[-1]),time.time()-start))
+        median = lambda values: sorted(values)[len(values)//2]
+        return median([x[0] for x in times]),median([x[1] for x in times])
+
+    def fmt(result,i):
+        return 'failed' if result is None else '{0:.3f}s'.format(result[i])
+
+    rows = [('MODULE','IMPORT','INDEXED','PROCESS','INDEXED')]
+    for name in [x for x in modules.split(',') if x]:
+        before,after = run(name,plain),run(name,indexed)
+        rows.append((name,fmt(before,0),fmt(after,0),fmt(before,1),fmt(after,1)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(x.ljust(w) for x,w in zip(row,widths)).rstrip())
+
 @command()
 def connect_session(host=('h',HOST,'specify the host machine'),
                     port=('p',2815,'specify the port'),
                     args=('','','specify args')):
     setenv.set_env_omniorb(host,port)
     # get the configuration
-    config = os.path.join(
-        setenv.getCacheDir(),'salome_launcher',
-        '{0}:{1}.json'.format(host,port))
+    config = getSessionCacheFile(host,port)
     try:
-        setenv.set_env(read_config(config))
+        configuration = read_config(config)
+        # written by launch_session, not part of the configuration
+        configuration.pop('session',None)
+        snapshot = setenv.load_env_snapshot(
+            getSessionCacheFile(host,port,'.env.json'),configuration)
+        if snapshot is not None:
+            setenv.apply_env_snapshot(snapshot)
+        else:
+            # outdated or missing, compute it again
+            setenv.set_env(configuration)
         os.environ['CUSTOM_PROMPT_PREFIX'] = '{0} salome {host}:{port}'.format(
             os.getenv('CUSTOM_PROMPT_PREFIX',''),host=host,port=port)
     except:
@@ -306,10 +661,173 @@ def connect_session(host=('h',HOST,'specify the host machine'),
     else:
         os.execvp('/usr/bin/zsh',['/usr/bin/zsh','-c',args])
 
+@command()
+def stats(host=('h',HOST,'specify the host machine'),
+          port=('p',2815,'specify the port')):
+    """print the resource usage of the services of a running session
+
+    the session must have been launched with --metrics-interval
+    """
+    from salome_metrics import format_samples
+    metricsfile = getSessionCacheFile(host,port,'.metrics.json')
+    try:
+        with open(metricsfile,'r') as store:
+            metrics = json.load(store)
+    except IOError:
+        print('no metrics for {0}:{1}.\n'
+              'is the session running with --metrics-interval?'.format(host,port))
+        return False
+    latest = metrics['samples'][-1]
+    print('salome {0}, sampled {1}'.format(
+        metrics['session'],
+        datetime.datetime.fromtimestamp(latest['time']).strftime('%Y-%m-%d %H:%M:%S')))
+    print(format_samples(latest['processes']))
+
+@command()
+def daemon(socket=('','','path of the control socket'),
+           timeout=('t',60,'seconds to wait for each service to get ready'),
+           shutdown_timeout=('',10,'seconds to wait for the services to terminate before killing them')):
+    """run many sessions in one process, controlled with the daemon_* commands"""
+    from salome_daemon import Daemon
+
+    def build(session):
+        session.rmfiles.append(setenv.make_runtime_dir(session.host,session.port))
+        configuration = session.configuration
+        graph = session_graph(
+            configuration,session.host,session.port,session.modules,
+            session.services,timeout=float(timeout),env=session.env,
+            limits=lambda name: configuration.get('services',{}).get(name))
+        return graph,restart_policies(configuration)
+
+    Daemon(build,socketpath=socket or None,shutdown_timeout=shutdown_timeout,
+           cache_path=getSessionCacheFile).run()
+
+def _daemon_request(command,socketpath,**kwargs):
+    from salome_daemon import request
+    try:
+        response = request(command,socketpath or None,**kwargs)
+    except socket.error as e:
+        print('failed to reach the daemon: {0}'.format(e))
+        return None
+    if not response.get('ok'):
+        print(response.get('error'))
+        return None
+    return response
+
+def _print_session(response):
+    print('{session}  {state}  {config}'.format(**response))
+    if response['reason']:
+        print('  {0}'.format(response['reason']))
+
+@command()
+def daemon_start(config,
+                 host=('h',HOST,'specify the host machine'),
+                 port=('p',2815,'specify the port'),
+                 modules=('m','','specify a list of modules to load'),
+                 nogui=('',False,'don\'launch gui'),
+                 services=('s','CPP,GUI,SPLASH','specify a list of services to load (CPP,GUI,SPLAH)'),
+                 wait=('w',False,'wait until the session is running'),
+                 socket=('','','path of the control socket')):
+    """start a session in the daemon"""
+    services = [x.upper() for x in services.split(',')]
+    if nogui:
+        services = [x for x in services if x != 'GUI']
+    response = _daemon_request(
+        'start',socket,config=os.path.abspath(config),host=host,port=int(port),
+        modules=[x.upper() for x in modules.split(',') if x] or None,
+        services=services)
+    if response is None:
+        return False
+    key = response['session']
+    while wait and response['state'] == 'starting':
+        time.sleep(0.2)
+        response = _daemon_request('inspect',socket,session=key)
+        if response is None:
+            return False
+    _print_session(response)
+    if response['state'] in ('stopped','failed'):
+        return False
+
+@command(usage='HOST:PORT')
+def daemon_stop(session,socket=('','','path of the control socket')):
+    """stop a session of the daemon"""
+    response = _daemon_request('stop',socket,session=session)
+    if response is None:
+        return False
+    _print_session(response)
+
+@command()
+def daemon_list(socket=('','','path of the control socket')):
+    """list the sessions of the daemon"""
+    response = _daemon_request('list',socket)
+    if response is None:
+        return False
+    for item in response['sessions']:
+        _print_session(item)
+
+@command(usage='HOST:PORT')
+def daemon_inspect(session,socket=('','','path of the control socket')):
+    """show the services of a session of the daemon and their last output"""
+    response = _daemon_request('inspect',socket,session=session)
+    if response is None:
+        return False
+    _print_session(response)
+    for service in response['services']:
+        print('  {name} (pid {pid}) {status}'.format(**service))
+        for stream in ('stdout','stderr'):
+            if service[stream].strip():
+                print('    {0}:'.format(stream))
+                for line in service[stream].rstrip().splitlines()[-10:]:
+                    print('      {0}'.format(line))
+
+@command()
+def pool_serve(config,
+               name=('n','default','name of the pool'),
+               size=('s',2,'number of idle sessions to keep ready'),
+               host=('h',HOST,'specify the host machine'),
+               ports=('','2900-2999','range of ports for the sessions'),
+               args=('','','extra arguments for launch_session')):
+    """keep a pool of idle sessions ready for pool_checkout"""
+    from salome_pool import PoolManager
+    manager = PoolManager(config,name=name,size=size,host=host,ports=ports,
+                          args=args.split())
+    manager.run()
+
+@command()
+def pool_checkout(name=('n','default','name of the pool'),
+                  timeout=('t',60,'seconds to wait for an idle session')):
+    """take an idle session from the pool and print its host:port
+
+    the session is returned automatically if the calling process exits,
+    connect to it with connect_session
+    """
+    from salome_pool import checkout
+    try:
+        session = checkout(name,timeout=float(timeout))
+    except RuntimeError as e:
+        print(e)
+        return False
+    if session is None:
+        print('no idle session in pool {0} after {1}s'.format(name,timeout))
+        return False
+    print('{0}:{1}'.format(*session))
+
+@command(usage='HOST:PORT')
+def pool_return(session,name=('n','default','name of the pool')):
+    """give a session back to the pool, it gets replaced by a fresh one"""
+    from salome_pool import give_back
+    host,port = session.rsplit(':',1)
+    if not give_back(host,int(port),name):
+        print('{0} is not checked out from pool {1}'.format(session,name))
+        return False
+
 @command()
 def resolve(host=('h',HOST,'specify the host machine'),
                   port=('p',2815,'specify the port')):
-    set_env_omniorb(host,port)
+    # only this command talks corba, so import it here
+    from omniORB import CORBA
+    import CosNaming
+    setenv.set_env_omniorb(host,port)
     orb = CORBA.ORB_init()
     obj = orb.resolve_initial_references("NameService")
     rootContext = obj._narrow(CosNaming.NamingContext)
@@ -0,0 +1,138 @@
+#  -*- coding: iso-8859-1 -*-
+# cpu placement and resource limits of the launched services
+
+import os
+import glob
+import json
+import fcntl
+import resource
+
+from salome_utils import isProcessAlive
+
+# names usable for the rlimits in the config and on the command line
+RLIMITS = {
+    'as':resource.RLIMIT_AS,
+    'nofile':resource.RLIMIT_NOFILE,
+    'core':resource.RLIMIT_CORE,
+}
+
+
+def parse_cpus(cpus):
+    """Set of cpus from a cpu list like '0-3,8,10-11' or a list of ints"""
+    if isinstance(cpus,(list,tuple,set)):
+        return set(int(x) for x in cpus)
+    result = set()
+    for part in str(cpus).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            a,b = part.split('-',1)
+            result.update(range(int(a),int(b)+1))
+        else:
+            result.add(int(part))
+    return result
+
+def format_cpus(cpus):
+    return ','.join(str(x) for x in sorted(cpus))
+
+def parse_rlimits(rlimits):
+    """Dict of rlimits from 'as=8000000000,core=0' or a dict
+
+    A value is either a single number used as soft and hard limit, a pair of
+    (soft,hard) or 'unlimited'.
+    """
+    if not isinstance(rlimits,dict):
+        rlimits = dict(x.split('=',1) for x in str(rlimits).split(',') if x)
+    result = {}
+    for name,value in rlimits.items():
+        if name not in RLIMITS:
+            raise ValueError('unknown rlimit {0}, use one of {1}'.format(
+                name,', '.join(sorted(RLIMITS))))
+        if not isinstance(value,(list,tuple)):
+            value = (value,value)
+        result[name] = tuple(
+            resource.RLIM_INFINITY if x == 'unlimited' else int(x)
+            for x in value)
+    return result
+
+def merge_limits(*limits):
+    """Merge limit dicts, later ones take precedence"""
+    result = {}
+    for item in limits:
+        for key,value in (item or {}).items():
+            if key == 'rlimits':
+                rlimits = dict(result.get('rlimits',{}))
+                rlimits.update(parse_rlimits(value))
+                result['rlimits'] = rlimits
+            elif value is not None and value != '':
+                result[key] = value
+    return result
+
+def prepare(args, limits=None):
+    """Return (args,preexec_fn) applying the limits to the child
+
+    limits is a dict with the optional keys cpus, nice and rlimits. The
+    preexec_fn runs in the child before the exec and also puts it into its
+    own process group. Without os.sched_setaffinity (python 2) the affinity
+    is set by running the command through taskset.
+    """
+    limits = limits or {}
+    cpus = parse_cpus(limits['cpus']) if limits.get('cpus') else None
+    nice = limits.get('nice')
+    rlimits = parse_rlimits(limits.get('rlimits',{}))
+    setaffinity = getattr(os,'sched_setaffinity',None)
+    if cpus and setaffinity is None:
+        args = ['taskset','-c',format_cpus(cpus)]+list(args)
+    def preexec():
+        os.setsid()
+        if cpus and setaffinity is not None:
+            setaffinity(0,cpus)
+        if nice:
+            os.nice(int(nice))
+        for name,value in rlimits.items():
+            resource.setrlimit(RLIMITS[name],value)
+    return args,preexec
+
+def numa_nodes():
+    """Dict mapping the numa node number to its set of cpus"""
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*'):
+        try:
+            with open(os.path.join(path,'cpulist')) as f:
+                cpus = parse_cpus(f.read())
+        except IOError:
+            continue
+        if cpus:
+            nodes[int(os.path.basename(path)[4:])] = cpus
+    if not nodes:
+        nodes[0] = set(range(os.sysconf('SC_NPROCESSORS_ONLN')))
+    return nodes
+
+def place_session(placedir, session):
+    """Choose the numa node with the fewest running sessions
+
+    The choice is recorded in placedir as <session>.placement, remove it when
+    the session ends, sessions whose launcher died are ignored.
+    Returns (placementfile,cpus).
+    """
+    if not os.path.isdir(placedir):
+        os.makedirs(placedir)
+    nodes = numa_nodes()
+    with open(os.path.join(placedir,'placement.lock'),'w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        load = dict((node,0) for node in nodes)
+        for path in glob.glob(os.path.join(placedir,'*.placement')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (IOError,ValueError):
+                continue
+            if data['node'] in load and isProcessAlive(data['pid']):
+                load[data['node']] += 1
+        node = min(sorted(load),key=lambda x:load[x])
+        placementfile = os.path.join(placedir,'{0}.placement'.format(session))
+        with open(placementfile,'w') as f:
+            json.dump({'node':node,'pid':os.getpid(),
+                       'cpus':format_cpus(nodes[node])},f)
+    return placementfile,nodes[node]
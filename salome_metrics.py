@@ -0,0 +1,167 @@
+#  -*- coding: iso-8859-1 -*-
+# sample the resource usage of the processes of a session from /proc and
+# export it as prometheus text file and as rolling json file
+
+import os
+import json
+import time
+import logging
+
+from salome_supervisor import group_members
+
+logger = logging.getLogger('salome')
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+METRICS = [
+    # (key, prometheus name, type, help)
+    ('cpu_seconds','salome_process_cpu_seconds_total','counter',
+     'user and system cpu time of the process'),
+    ('rss_bytes','salome_process_resident_memory_bytes','gauge',
+     'resident set size of the process'),
+    ('pss_bytes','salome_process_proportional_memory_bytes','gauge',
+     'proportional set size of the process'),
+    ('fds','salome_process_open_fds','gauge',
+     'number of open file descriptors'),
+    ('threads','salome_process_threads','gauge',
+     'number of threads'),
+]
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def sample_pid(pid):
+    """Resource usage of a process, None if it is gone"""
+    proc = '/proc/{0}'.format(pid)
+    try:
+        stat = _read(os.path.join(proc,'stat'))
+        status = _read(os.path.join(proc,'status'))
+    except IOError:
+        return None
+    command = stat[stat.index('(')+1:stat.rindex(')')]
+    fields = stat[stat.rindex(')')+2:].split()
+    data = {
+        'pid':pid,
+        'command':command,
+        # utime and stime are the fields 14 and 15 of stat
+        'cpu_seconds':(int(fields[11])+int(fields[12]))/float(CLK_TCK),
+        'rss_bytes':None,
+        'pss_bytes':None,
+        'fds':None,
+        'threads':None,
+    }
+    for line in status.splitlines():
+        if line.startswith('VmRSS:'):
+            data['rss_bytes'] = int(line.split()[1])*1024
+        elif line.startswith('Threads:'):
+            data['threads'] = int(line.split()[1])
+    try:
+        for line in _read(os.path.join(proc,'smaps_rollup')).splitlines():
+            if line.startswith('Pss:'):
+                data['pss_bytes'] = int(line.split()[1])*1024
+                break
+    except IOError:
+        pass
+    try:
+        data['fds'] = len(os.listdir(os.path.join(proc,'fd')))
+    except OSError:
+        pass
+    return data
+
+def sample(processes):
+    """Sample all processes of the session
+
+    Besides the service processes themselves, all members of their process
+    groups are sampled too, e.g. the containers started by a server.
+    """
+    samples = []
+    for name,proc in processes:
+        if proc.poll() is not None:
+            continue
+        pids = [proc.pid]+sorted(
+            x for x in group_members(proc.pid) if x != proc.pid)
+        for pid in pids:
+            data = sample_pid(pid)
+            if data is not None:
+                data['service'] = name
+                samples.append(data)
+    return samples
+
+def _write_atomic(path, data):
+    tmp = '{0}.tmp'.format(path)
+    with open(tmp,'w') as f:
+        f.write(data)
+    os.rename(tmp,path)
+
+def to_prometheus(samples, session):
+    lines = []
+    for key,name,kind,helptext in METRICS:
+        lines.append('# HELP {0} {1}'.format(name,helptext))
+        lines.append('# TYPE {0} {1}'.format(name,kind))
+        for data in samples:
+            if data[key] is None:
+                continue
+            lines.append(
+                '{0}{{session="{1}",service="{2}",pid="{3}",command="{4}"}} {5}'.format(
+                    name,session,data['service'],data['pid'],
+                    data['command'].replace('\\','\\\\').replace('"','\\"'),
+                    data[key]))
+    return '\n'.join(lines)+'\n'
+
+
+class MetricsRecorder(object):
+    """Sample the processes periodically from the supervisor loop
+
+    Every sample replaces the prometheus text file and is appended to the
+    json file, which keeps the last keep samples.
+    """
+
+    def __init__(self, supervisor, session, promfile, jsonfile, interval=10.,
+                 keep=60):
+        self.supervisor = supervisor
+        self.session = session
+        self.promfile = promfile
+        self.jsonfile = jsonfile
+        self.interval = interval
+        self.keep = keep
+        self.history = []
+
+    def start(self):
+        self.record()
+
+    def record(self):
+        try:
+            samples = sample(self.supervisor.processes)
+            self.history.append({'time':time.time(),'processes':samples})
+            del self.history[:-self.keep]
+            _write_atomic(self.promfile,to_prometheus(samples,self.session))
+            _write_atomic(self.jsonfile,json.dumps(
+                {'session':self.session,'samples':self.history}))
+        except Exception as e:
+            logger.warning('failed to record metrics: {0}'.format(e))
+        self.supervisor.call_later(self.interval,self.record)
+
+def _format_bytes(value):
+    if value is None:
+        return '-'
+    for unit in ('B','K','M','G'):
+        if value < 1024 or unit == 'G':
+            break
+        value /= 1024.
+    return '{0:.1f}{1}'.format(value,unit)
+
+def format_samples(samples):
+    """Table of the latest sample, one line per process"""
+    rows = [('SERVICE','PID','COMMAND','CPU','RSS','PSS','FDS','THREADS')]
+    for data in samples:
+        rows.append((
+            data['service'],str(data['pid']),data['command'],
+            '{0:.2f}s'.format(data['cpu_seconds']),
+            _format_bytes(data['rss_bytes']),_format_bytes(data['pss_bytes']),
+            '-' if data['fds'] is None else str(data['fds']),
+            '-' if data['threads'] is None else str(data['threads'])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(x.ljust(w) for x,w in zip(row,widths)).rstrip()
+                     for row in rows)
@@ -0,0 +1,77 @@
+#  -*- coding: iso-8859-1 -*-
+# naming sub contexts for sessions sharing one omniNames and notifd, a session
+# uses corbaname::host:port#<context> as its NameService, so its servers
+# register below the context instead of in the root
+
+import re
+import logging
+
+logger = logging.getLogger('salome')
+
+
+def _root(host, port):
+    from omniORB import CORBA
+    import CosNaming
+    orb = CORBA.ORB_init([''],CORBA.ORB_ID)
+    obj = orb.string_to_object('corbaname::{0}:{1}'.format(host,port))
+    return obj._narrow(CosNaming.NamingContext)
+
+def _bindings(context):
+    bindings,iterator = context.list(1000)
+    bindings = list(bindings)
+    if iterator is not None:
+        while True:
+            more,rest = iterator.next_n(1000)
+            bindings.extend(rest)
+            if not more:
+                break
+        iterator.destroy()
+    return bindings
+
+def _destroy(context):
+    """Unbind everything below the context and destroy it"""
+    import CosNaming
+    for binding in _bindings(context):
+        if binding.binding_type == CosNaming.ncontext:
+            _destroy(context.resolve(binding.binding_name)._narrow(
+                CosNaming.NamingContext))
+        context.unbind(binding.binding_name)
+    context.destroy()
+
+def context_name(host, port):
+    """Name of the sub context of the session host:port, no escaping needed"""
+    return re.sub(r'[^A-Za-z0-9_]','_','session_{0}_{1}'.format(host,port))
+
+def create_session_context(nshost, nsport, name):
+    """Create the sub context and return the corbaname url of it
+
+    The objects bound in the root, like the channel of the shared notifd,
+    are bound in the sub context too, so the servers of the session find them
+    under their usual names. A context of the same name is left over from a
+    session that was killed, launch_session holds the reservation of the
+    port for the whole session, so it is replaced.
+    """
+    import CosNaming
+    root = _root(nshost,nsport)
+    path = [CosNaming.NameComponent(name,'')]
+    try:
+        context = root.bind_new_context(path)
+    except CosNaming.NamingContext.AlreadyBound:
+        logger.warning('replacing the stale naming context {0}'.format(name))
+        remove_session_context(nshost,nsport,name)
+        context = root.bind_new_context(path)
+    for binding in _bindings(root):
+        if binding.binding_type == CosNaming.nobject:
+            context.rebind(binding.binding_name,root.resolve(binding.binding_name))
+    return 'corbaname::{0}:{1}#{2}'.format(nshost,nsport,name)
+
+def remove_session_context(nshost, nsport, name):
+    import CosNaming
+    root = _root(nshost,nsport)
+    path = [CosNaming.NameComponent(name,'')]
+    try:
+        context = root.resolve(path)._narrow(CosNaming.NamingContext)
+    except CosNaming.NamingContext.NotFound:
+        return
+    _destroy(context)
+    root.unbind(path)
@@ -0,0 +1,191 @@
+#  -*- coding: iso-8859-1 -*-
+# pool of pre launched sessions, a long running manager keeps a number of
+# idle sessions ready, clients check them out and return them when done
+
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import signal
+import logging
+import subprocess
+from contextlib import contextmanager
+
+from salome_utils import getLauncherCacheDir,getSessionCacheFile,isProcessAlive
+from salome_supervisor import Supervisor,describe_status,terminate
+from salome_startup import parse_ports,bindable
+
+logger = logging.getLogger('salome')
+
+# states of a session in the pool
+STARTING = 'starting'
+IDLE = 'idle'
+BUSY = 'busy'
+RETURNED = 'returned'
+RETIRING = 'retiring'
+
+
+@contextmanager
+def locked_state(name):
+    """The state of the pool, locked and written back after the with block"""
+    statefile = os.path.join(getLauncherCacheDir(),'pool-{0}.json'.format(name))
+    with open(statefile+'.lock','w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            with open(statefile,'r') as store:
+                state = json.load(store)
+        except (IOError,ValueError):
+            state = {'manager':None,'sessions':{}}
+        yield state
+        tmp = statefile+'.tmp'
+        with open(tmp,'w') as store:
+            json.dump(state,store,sort_keys=True,indent=4)
+        os.rename(tmp,statefile)
+
+def checkout(name='default', timeout=60.):
+    """Take an idle session, returns (host,port) or None after the timeout"""
+    deadline = time.time()+timeout
+    interval = 0.05
+    while True:
+        with locked_state(name) as state:
+            if state['manager'] is None or not isProcessAlive(state['manager']):
+                raise RuntimeError('no manager running for pool {0}'.format(name))
+            for key,session in sorted(state['sessions'].items()):
+                if session['state'] == IDLE:
+                    session['state'] = BUSY
+                    session['owner'] = os.getppid()
+                    session['since'] = time.time()
+                    return session['host'],session['port']
+        if time.time() >= deadline:
+            return None
+        time.sleep(interval)
+        interval = min(interval*2,1.)
+
+def give_back(host, port, name='default'):
+    """Return a checked out session, the manager replaces it"""
+    with locked_state(name) as state:
+        session = state['sessions'].get('{0}:{1}'.format(host,port))
+        if session is None or session['state'] != BUSY:
+            return False
+        session['state'] = RETURNED
+        return True
+
+
+class PoolSupervisor(Supervisor):
+    """A session exiting is no reason to stop the pool"""
+
+    def on_exit(self, name, proc):
+        pass
+
+
+def _ready(session):
+    """Whether the launcher of the session finished starting it
+
+    Files left by a killed launcher on the same port don't count, the cache
+    entry has to name the launcher of this session.
+    """
+    host,port = session['host'],session['port']
+    if not os.path.isfile(getSessionCacheFile(host,port,'.env.json')):
+        return False
+    try:
+        with open(getSessionCacheFile(host,port),'r') as store:
+            entry = json.load(store)
+    except (IOError,ValueError):
+        return False
+    return entry.get('session',{}).get('pid') == session['pid']
+
+
+class PoolManager(object):
+    """Keep size idle sessions ready
+
+    The sessions are launched with launch-session --nogui on ports of the
+    given range. A session is idle once its environment snapshot exists and
+    its cache entry names the launcher started for it, launch_session writes
+    both after all services are ready. Returned
+    sessions are shut down and replaced by fresh ones, as are sessions whose
+    checkout owner died.
+    """
+
+    def __init__(self, config, name='default', size=2, host='127.0.0.1',
+                 ports='2900-2999', interval=1., args=()):
+        self.config = os.path.abspath(config)
+        self.name = name
+        self.size = int(size)
+        self.host = host
+        self.ports = parse_ports(ports)
+        self.interval = float(interval)
+        self.args = list(args)
+        self.supervisor = PoolSupervisor()
+        self.procs = {}
+
+    def launch(self, port):
+        args = [sys.executable,'-m','salome_launcher','launch-session',
+                '--nogui','-h',self.host,'-p',str(port)]+self.args+[self.config]
+        proc = subprocess.Popen(
+            args,stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+            preexec_fn=os.setsid)
+        key = '{0}:{1}'.format(self.host,port)
+        self.procs[key] = proc
+        self.supervisor.add(key,proc)
+        logger.info('launching pool session {0}'.format(key))
+        return {'host':self.host,'port':port,'pid':proc.pid,
+                'state':STARTING,'owner':None,'since':time.time()}
+
+    def reconcile(self):
+        with locked_state(self.name) as state:
+            state['manager'] = os.getpid()
+            sessions = state['sessions']
+            for key,session in list(sessions.items()):
+                proc = self.procs.get(key)
+                if proc is None or proc.poll() is not None:
+                    if proc is not None:
+                        logger.info('pool session {0} {1}'.format(
+                            key,describe_status(proc.returncode)))
+                        self.supervisor.discard(key)
+                        del self.procs[key]
+                    del sessions[key]
+                    continue
+                if session['state'] == STARTING and _ready(session):
+                    session['state'] = IDLE
+                    logger.info('pool session {0} is ready'.format(key))
+                elif session['state'] == BUSY and session['owner'] and \
+                        not isProcessAlive(session['owner']):
+                    session['state'] = RETURNED
+                if session['state'] == RETURNED:
+                    session['state'] = RETIRING
+                    try:
+                        os.killpg(proc.pid,signal.SIGTERM)
+                    except OSError as e:
+                        # exited meanwhile, the next round removes it
+                        if e.errno != errno.ESRCH:
+                            raise
+            # refill
+            ready = [x for x in sessions.values() if x['state'] in (STARTING,IDLE)]
+            used = set(x['port'] for x in sessions.values())
+            for port in self.ports:
+                if len(ready) >= self.size:
+                    break
+                if port in used or not bindable(self.host,port):
+                    continue
+                session = self.launch(port)
+                sessions['{0}:{1}'.format(self.host,port)] = session
+                ready.append(session)
+            if len(ready) < self.size:
+                logger.warning('no free ports left in the pool range')
+        self.supervisor.call_later(self.interval,self.reconcile)
+
+    def run(self):
+        self.supervisor.install()
+        try:
+            self.reconcile()
+            reason = self.supervisor.run()
+            logger.info('pool {0} stopped: {1}'.format(self.name,reason))
+        finally:
+            self.supervisor.uninstall()
+            # the launchers shut down their sessions on SIGTERM
+            terminate(list(self.procs.items()),timeout=60.)
+            with locked_state(self.name) as state:
+                state['manager'] = None
+                state['sessions'] = {}
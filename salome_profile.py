@@ -0,0 +1,114 @@
+#  -*- coding: iso-8859-1 -*-
+# record a timeline of the session startup, the in process phases as well as
+# the spawned processes, to find out where the launch time goes
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Timeline(object):
+    """Startup timeline, does nothing until it is enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.origin = time.time()
+        self.phases = []
+        self.processes = {}
+
+    def enable(self):
+        self.enabled = True
+        self.reset()
+
+    def _now(self):
+        return time.time()-self.origin
+
+    @contextmanager
+    def phase(self, name):
+        """Time the code in the with block as phase name"""
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append({
+                    'name':name,'start':start,'end':self._now()})
+
+    def spawned(self, name, proc):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.processes[name] = {
+                'name':name,'pid':proc.pid,'spawn':self._now(),
+                'ready':None,'first_output':None}
+
+    def ready(self, name):
+        if not self.enabled:
+            return
+        with self._lock:
+            if name in self.processes:
+                self.processes[name]['ready'] = self._now()
+
+    def first_output(self, name):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.processes.get(name)
+            if entry is not None and entry['first_output'] is None:
+                entry['first_output'] = self._now()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'origin':self.origin,
+                'phases':sorted(self.phases,key=lambda x:x['start']),
+                'processes':sorted(
+                    self.processes.values(),key=lambda x:x['spawn']),
+            }
+
+    def save(self, path):
+        with open(path,'w') as store:
+            json.dump(self.to_dict(),store,sort_keys=True,indent=4)
+
+    def waterfall(self, width=50):
+        """Text summary, one bar per phase and per process
+
+        For processes the bar spans from the spawn until the process was ready,
+        the first output is marked with a '|'.
+        """
+        data = self.to_dict()
+        rows = []
+        for phase in data['phases']:
+            rows.append((phase['name'],phase['start'],phase['end'],None))
+        for proc in data['processes']:
+            rows.append((proc['name'],proc['spawn'],
+                         proc['ready'] if proc['ready'] is not None else proc['spawn'],
+                         proc['first_output']))
+        if not rows:
+            return ''
+        ends = [x[2] for x in rows]+[x[3] for x in rows if x[3] is not None]
+        total = max(ends) or 1.
+        namewidth = max(len(x[0]) for x in rows)
+        lines = []
+        for name,start,end,output in rows:
+            a = int(round(start/total*width))
+            b = max(int(round(end/total*width)),a+1)
+            bar = [' ']*width+[' ']
+            for i in range(a,b):
+                bar[i] = '#'
+            if output is not None:
+                bar[min(int(round(output/total*width)),width)] = '|'
+            lines.append('{0}  {1:8.3f}s {2:8.3f}s  {3}'.format(
+                name.ljust(namewidth),start,end-start,''.join(bar).rstrip()))
+        lines.append('{0}  total {1:.3f}s'.format(' '*namewidth,total))
+        return '\n'.join(lines)
+
+timeline = Timeline()
@@ -0,0 +1,281 @@
+#  -*- coding: iso-8859-1 -*-
+# start the salome services as a dependency graph, every service is spawned as
+# soon as all the services it requires are ready
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import socket
+import threading
+import logging
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger('salome')
+
+
+class NotReadyError(RuntimeError):
+    pass
+
+
+def wait_for(check, proc=None, timeout=60., interval=0.01, max_interval=0.5,
+             what='service'):
+    """Call check until it returns True, backing off exponentially
+
+    Raises NotReadyError if the timeout expires or if the process dies
+    before the check passed.
+    """
+    deadline = time.time()+timeout
+    while True:
+        if proc is not None and proc.poll() is not None:
+            raise NotReadyError('{0} exited with {1} before it was ready'.format(
+                what,proc.returncode))
+        try:
+            if check():
+                return
+        except Exception as e:
+            logger.debug('probing {0} failed: {1}'.format(what,e))
+        now = time.time()
+        if now >= deadline:
+            raise NotReadyError('{0} not ready after {1}s'.format(what,timeout))
+        time.sleep(min(interval,deadline-now))
+        interval = min(interval*2,max_interval)
+
+def port_probe(host,port):
+    """Ready as soon as something accepts connections on host:port"""
+    def check():
+        try:
+            sock = socket.create_connection((host,port),timeout=1)
+        except socket.error:
+            return False
+        sock.close()
+        return True
+    return check
+
+def file_probe(path):
+    """Ready as soon as the file exists and is not empty, e.g. an IOR file"""
+    def check():
+        return os.path.isfile(path) and os.path.getsize(path) > 0
+    return check
+
+def name_probe(name, nameservice=None):
+    """Ready as soon as the name resolves in the NameService
+
+    The name is given in the salome notation, e.g. '/Kernel/Session', where
+    all but the last component are directories. nameservice is a corbaname
+    url like 'corbaname::host:port', by default the initial reference of the
+    omniORB config is used.
+    """
+    def check():
+        from omniORB import CORBA
+        import CosNaming
+        orb = CORBA.ORB_init([''],CORBA.ORB_ID)
+        if nameservice is None:
+            obj = orb.resolve_initial_references('NameService')
+        else:
+            obj = orb.string_to_object(nameservice)
+        root = obj._narrow(CosNaming.NamingContext)
+        parts = [x for x in name.split('/') if x]
+        path = [CosNaming.NameComponent(x,'dir') for x in parts[:-1]]
+        path.append(CosNaming.NameComponent(parts[-1],'object'))
+        try:
+            root.resolve(path)
+        except (CosNaming.NamingContext.NotFound,CORBA.TRANSIENT,
+                CORBA.COMM_FAILURE):
+            return False
+        return True
+    return check
+
+def parse_ports(ports):
+    """List of ports from a range like '2900-2999' or a list like '2815,2816'"""
+    if '-' in str(ports):
+        a,b = str(ports).split('-',1)
+        return list(range(int(a),int(b)+1))
+    return [int(x) for x in str(ports).split(',') if x]
+
+def bindable(host, port):
+    sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    # like the servers do, a port in TIME_WAIT is usable
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    try:
+        sock.bind((host,port))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class PortReservation(object):
+    """The first free port of a range, reserved until released
+
+    A port is reserved by holding a flock on lockdir/port-<host>:<port>.lock,
+    concurrent launchers skip locked ports, so they never pick the same one
+    even before a server listens on it. Release it once the server owns the
+    port. The lock files are left behind, removing them would race.
+    """
+
+    def __init__(self, host, ports, lockdir):
+        self.host = host
+        self.port = None
+        self._lock = None
+        for port in parse_ports(ports):
+            path = os.path.join(lockdir,'port-{0}:{1}.lock'.format(host,port))
+            lock = open(path,'w')
+            # the services must not inherit the lock
+            flags = fcntl.fcntl(lock,fcntl.F_GETFD)
+            fcntl.fcntl(lock,fcntl.F_SETFD,flags|fcntl.FD_CLOEXEC)
+            try:
+                fcntl.flock(lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except IOError as e:
+                lock.close()
+                if e.errno not in (errno.EAGAIN,errno.EACCES):
+                    raise
+                continue
+            if bindable(host,port):
+                self.port = port
+                self._lock = lock
+                break
+            lock.close()
+        if self.port is None:
+            raise RuntimeError('no free port in {0} on {1}'.format(ports,host))
+
+    def release(self):
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+def probe(*checks, **kwargs):
+    """Create a ready function for ServiceGraph.add out of probes
+
+    The checks are waited for one after another, each with its own timeout.
+    """
+    def ready(proc):
+        for check in checks:
+            wait_for(check,proc=proc,**kwargs)
+    return ready
+
+
+class ServiceGraph(object):
+    """Dependency graph of services
+
+    Every service is described by a start function returning either a process
+    or a tuple of (process,rmfiles) and an optional ready function which blocks
+    until the process is usable. The processes are spawned from the calling
+    thread, only the ready functions run in worker threads, so independent
+    services are waited for concurrently.
+    """
+
+    def __init__(self):
+        self.services = []
+        self._names = {}
+
+    def add(self, name, start, requires=(), ready=None):
+        if name in self._names:
+            raise ValueError('service {0} already defined'.format(name))
+        self._names[name] = len(self.services)
+        self.services.append((name,start,tuple(requires),ready))
+
+    def check(self):
+        """Make sure all requirements exist and there are no cycles"""
+        done = set()
+        visiting = set()
+        def visit(name,chain):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError('dependency cycle: {0}'.format(
+                    ' -> '.join(chain+[name])))
+            if name not in self._names:
+                raise ValueError('unknown service {0} required by {1}'.format(
+                    name,chain[-1]))
+            visiting.add(name)
+            for req in self.services[self._names[name]][2]:
+                visit(req,chain+[name])
+            visiting.remove(name)
+            done.add(name)
+        for name,start,requires,ready in self.services:
+            visit(name,[])
+
+    def spawn(self, name):
+        """Spawn the service without waiting, return (process,rmfiles)"""
+        start = self.services[self._names[name]][1]
+        res = start()
+        if isinstance(res,tuple):
+            proc,rmfiles = res
+        else:
+            proc,rmfiles = res,[]
+        return proc,list(rmfiles)
+
+    def _wait_ready(self, name, ready, proc, events):
+        try:
+            ready(proc)
+        except Exception:
+            events.put((name,sys.exc_info()))
+        else:
+            events.put((name,None))
+
+    def start(self, started=None, on_ready=None, idle=None, timeout=0.1):
+        """Start all services, return a dict mapping the name to the process
+
+        :started: callback called with (name,process,rmfiles) right after a
+            service was spawned, use it to register the process for the clean
+            up, as on errors the already spawned processes are not touched here
+        :on_ready: callback called with the name once a service is ready
+        :idle: function called with a timeout in seconds while waiting for
+            services to get ready, e.g. to drain their output meanwhile
+        """
+        self.check()
+        events = queue.Queue()
+        pending = list(self.services)
+        ready = set()
+        waiting = 0
+        procs = {}
+        while pending or waiting:
+            for service in list(pending):
+                name,start,requires,ready_func = service
+                if not all(req in ready for req in requires):
+                    continue
+                pending.remove(service)
+                logger.debug('starting {0}'.format(name))
+                proc,rmfiles = self.spawn(name)
+                procs[name] = proc
+                if started is not None:
+                    started(name,proc,rmfiles)
+                if ready_func is None:
+                    ready.add(name)
+                    if on_ready is not None:
+                        on_ready(name)
+                else:
+                    waiting += 1
+                    thread = threading.Thread(
+                        target=self._wait_ready,
+                        args=(name,ready_func,proc,events))
+                    thread.daemon = True
+                    thread.start()
+            if not waiting:
+                # everything spawned is ready, go on with the rest
+                continue
+            # a timeout keeps the main thread responsive to signals
+            try:
+                if idle is None:
+                    name,exc_info = events.get(timeout=timeout)
+                else:
+                    name,exc_info = events.get_nowait()
+            except queue.Empty:
+                if idle is not None:
+                    idle(timeout)
+                continue
+            waiting -= 1
+            if exc_info is not None:
+                raise exc_info[1]
+            logger.debug('{0} is ready'.format(name))
+            ready.add(name)
+            if on_ready is not None:
+                on_ready(name)
+        return procs
@@ -0,0 +1,506 @@
+#  -*- coding: iso-8859-1 -*-
+# supervision of the processes of a running session
+
+import os
+import time
+import heapq
+import errno
+import fcntl
+import select
+import signal
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('salome')
+
+# bytes of recent output kept per stream of every service
+OUTPUT_BUFFER_SIZE = 64*1024
+
+
+class ShutdownRequested(Exception):
+    pass
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+    fcntl.fcntl(fd,fcntl.F_SETFL,flags|os.O_NONBLOCK)
+
+
+class RingBuffer(object):
+    """Keep the last maxbytes of a byte stream"""
+
+    def __init__(self, maxbytes=OUTPUT_BUFFER_SIZE):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.chunks = deque()
+
+    def write(self, data):
+        if len(data) >= self.maxbytes:
+            self.chunks.clear()
+            data = data[-self.maxbytes:]
+            self.size = 0
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.maxbytes:
+            excess = self.size-self.maxbytes
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                self.size -= len(first)
+            else:
+                self.chunks[0] = first[excess:]
+                self.size -= excess
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+class OutputDrain(object):
+    """Read the stdout and stderr pipes of the services as data arrives
+
+    The pipes are registered in the given epoll object and made non blocking,
+    whoever polls it passes the events to handle. The output ends up in a
+    RingBuffer per stream, so a chatty service never blocks on a full pipe.
+    """
+
+    def __init__(self, poller, maxbytes=OUTPUT_BUFFER_SIZE, on_output=None):
+        self.poller = poller
+        self.maxbytes = maxbytes
+        self.on_output = on_output
+        self.buffers = {}
+        self._fds = {}
+
+    def add(self, name, proc):
+        self.buffers[name] = {}
+        for stream in ('stdout','stderr'):
+            pipe = getattr(proc,stream)
+            if pipe is None:
+                continue
+            fd = pipe.fileno()
+            _set_nonblocking(fd)
+            self.buffers[name][stream] = RingBuffer(self.maxbytes)
+            self._fds[fd] = (name,stream,pipe)
+            self.poller.register(fd,select.EPOLLIN|select.EPOLLHUP)
+
+    def _read(self, fd):
+        """Read everything available, return False on end of file"""
+        name,stream,pipe = self._fds[fd]
+        while True:
+            try:
+                data = os.read(fd,65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN,errno.EINTR):
+                    return True
+                raise
+            if not data:
+                return False
+            if self.on_output is not None:
+                self.on_output(name)
+            self.buffers[name][stream].write(data)
+
+    def _close(self, fd):
+        name,stream,pipe = self._fds.pop(fd)
+        try:
+            self.poller.unregister(fd)
+        except (IOError,ValueError):
+            pass
+        pipe.close()
+        return name,stream
+
+    def handle(self, fd, flags):
+        """Handle an epoll event
+
+        Returns (name,stream) if the stream reached the end of file, which
+        usually means the service exited, None otherwise.
+        """
+        if fd not in self._fds:
+            return None
+        if not self._read(fd):
+            return self._close(fd)
+        return None
+
+    def poll(self, timeout=-1):
+        """Poll and handle the events, return the streams which were closed"""
+        closed = []
+        try:
+            events = self.poller.poll(timeout)
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            return closed
+        for fd,flags in events:
+            res = self.handle(fd,flags)
+            if res is not None:
+                closed.append(res)
+        return closed
+
+    def flush(self):
+        """Read what is left in all pipes without blocking"""
+        for fd in list(self._fds):
+            if not self._read(fd):
+                self._close(fd)
+
+    def remove(self, name):
+        for fd,(_name,stream,pipe) in list(self._fds.items()):
+            if _name == name:
+                self._close(fd)
+
+    def output(self, name, stream='stderr'):
+        buf = self.buffers.get(name,{}).get(stream)
+        if buf is None:
+            return b''
+        return buf.getvalue()
+
+
+def signal_name(signum):
+    for name in sorted(dir(signal)):
+        if name.startswith('SIG') and not name.startswith('SIG_') and \
+           getattr(signal,name) == signum:
+            return name
+    return 'signal {0}'.format(signum)
+
+def describe_status(returncode):
+    if returncode is None:
+        return 'running'
+    if returncode < 0:
+        return 'killed by {0}'.format(signal_name(-returncode))
+    return 'exited with {0}'.format(returncode)
+
+
+def _killpg(proc, sig):
+    """Signal the process group of a process started with spawn"""
+    # never signal our own group, the process was not started as group leader
+    if proc.pid == os.getpgrp():
+        return False
+    try:
+        os.killpg(proc.pid,sig)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        if e.errno != errno.EPERM:
+            raise
+        # fallback to the process itself
+        if proc.poll() is None:
+            os.kill(proc.pid,sig)
+    return True
+
+def group_members(pgid):
+    """Pids of the living (not zombie) processes in the process group"""
+    members = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(entry)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command in the second field may contain spaces
+        fields = stat[stat.rindex(')')+2:].split()
+        if fields[0] != 'Z' and int(fields[2]) == pgid:
+            members.append(int(entry))
+    return members
+
+def _group_alive(proc):
+    if proc.poll() is None:
+        return True
+    # orphaned zombies are not our business, they only wait for init
+    return _killpg(proc,0) and bool(group_members(proc.pid))
+
+def terminate(processes, timeout=10., background=None):
+    """Terminate the process groups of all processes at once
+
+    All groups get SIGTERM at the same time and are waited for concurrently
+    until the common deadline, only the groups still alive afterwards get
+    SIGKILL. background is run in a thread meanwhile, e.g. to remove files.
+    """
+    thread = None
+    if background is not None:
+        thread = threading.Thread(target=background)
+        thread.start()
+    alive = [(name,proc) for name,proc in processes if _group_alive(proc)]
+    for name,proc in alive:
+        _killpg(proc,signal.SIGTERM)
+    deadline = time.time()+timeout
+    interval = 0.005
+    while alive:
+        alive = [(name,proc) for name,proc in alive if _group_alive(proc)]
+        now = time.time()
+        if not alive or now >= deadline:
+            break
+        time.sleep(min(interval,deadline-now))
+        interval = min(interval*2,0.1)
+    for name,proc in alive:
+        logger.warning('{0} (pid {1}) did not terminate within {2}s, killing'.format(
+            name,proc.pid,timeout))
+        _killpg(proc,signal.SIGKILL)
+    for name,proc in alive:
+        proc.wait()
+    if thread is not None:
+        thread.join()
+
+
+class RestartPolicy(object):
+    """When to restart a service which exited
+
+    :policy: one of 'never', 'on-failure' or 'always'
+    :max_restarts: give up after that many restarts
+    :delay: seconds before the first restart, doubled for every further one
+    """
+
+    POLICIES = ('never','on-failure','always')
+
+    def __init__(self, policy='never', max_restarts=3, delay=1.):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown restart policy {0}, use one of {1}'.format(
+                policy,', '.join(self.POLICIES)))
+        self.policy = policy
+        self.max_restarts = int(max_restarts)
+        self.delay = float(delay)
+
+    @classmethod
+    def from_config(cls, config):
+        """Create it from a policy name or a dict with the arguments"""
+        if isinstance(config,dict):
+            return cls(**config)
+        return cls(config)
+
+    def should_restart(self, returncode, restarts):
+        if self.policy == 'never' or restarts >= self.max_restarts:
+            return False
+        return self.policy == 'always' or returncode != 0
+
+    def backoff(self, restarts):
+        return self.delay*2**restarts
+
+
+class Supervisor(object):
+    """Event loop supervising the processes of a session
+
+    Child exits (SIGCHLD), the termination signals, the output pipes and
+    timers are all handled from one epoll object. Signals wake the loop through
+    signal.set_wakeup_fd, so without events it sleeps without any periodic
+    wake ups. By default the loop stops as soon as any process exits or a
+    termination signal arrives, reason tells why.
+    """
+
+    STOP_SIGNALS = (signal.SIGTERM,signal.SIGINT,signal.SIGHUP,signal.SIGQUIT)
+
+    def __init__(self, on_output=None):
+        self.poller = select.epoll()
+        self.drain = OutputDrain(self.poller,on_output=on_output)
+        self.processes = []
+        self.status = {}
+        self.reason = None
+        self._timers = []
+        self._timer_count = 0
+        self._signals = deque()
+        self._wakeup = None
+        self._handlers = {}
+        self._restart = {}
+        self._readers = {}
+
+    def add(self, name, proc):
+        self.processes.append((name,proc))
+        self.status.pop(name,None)
+        self.drain.add(name,proc)
+
+    def discard(self, name):
+        """Forget a process, e.g. after it exited"""
+        self.drain.remove(name)
+        self.drain.buffers.pop(name,None)
+        self.processes[:] = [x for x in self.processes if x[0] != name]
+        self.status.pop(name,None)
+        self._restart.pop(name,None)
+
+    def add_reader(self, fd, callback):
+        """Call callback with (fd,flags) whenever fd gets readable"""
+        self._readers[fd] = callback
+        self.poller.register(fd,select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd,None) is not None:
+            try:
+                self.poller.unregister(fd)
+            except (IOError,ValueError):
+                pass
+
+    def call_later(self, delay, callback):
+        self._timer_count += 1
+        heapq.heappush(
+            self._timers,(time.time()+delay,self._timer_count,callback))
+
+    def stop(self, reason):
+        if self.reason is None:
+            logger.info('shutting down: {0}'.format(reason))
+            self.reason = reason
+
+    def set_restart(self, name, start, policy):
+        """Restart the service according to policy if it exits
+
+        start is called without arguments and must return the new process.
+        """
+        self._restart[name] = [start,policy,0]
+
+    def cancel_restart(self, name):
+        self._restart.pop(name,None)
+
+    def on_exit(self, name, proc):
+        """Called once for every process which exited
+
+        Schedules a restart if the restart policy of the service allows it,
+        stops otherwise.
+        """
+        if not self.schedule_restart(name,proc):
+            self.stop('{0} {1}'.format(name,describe_status(proc.returncode)))
+
+    def schedule_restart(self, name, proc):
+        """Restart the process later if its policy allows, return if it will"""
+        status = describe_status(proc.returncode)
+        if name in self._restart and self.reason is None:
+            start,policy,restarts = self._restart[name]
+            if policy.should_restart(proc.returncode,restarts):
+                delay = policy.backoff(restarts)
+                logger.warning('{0} {1}, restarting in {2}s ({3}/{4})'.format(
+                    name,status,delay,restarts+1,policy.max_restarts))
+                err = self.drain.output(name,'stderr')
+                if err:
+                    logger.warning('last output of {0}:\n{1}'.format(
+                        name,err[-2048:]))
+                self.call_later(delay,lambda: self._respawn(name))
+                return True
+        return False
+
+    def _respawn(self, name):
+        # stopped meanwhile or discarded
+        if self.reason is not None or name not in self._restart:
+            return
+        entry = self._restart[name]
+        entry[2] += 1
+        index = [x[0] for x in self.processes].index(name)
+        # leftovers of the old process group must not survive
+        terminate([self.processes[index]],timeout=2.)
+        self.drain.remove(name)
+        try:
+            proc = entry[0]()
+        except Exception as e:
+            self.stop('restarting {0} failed: {1}'.format(name,e))
+            return
+        logger.info('restarted {0} as pid {1}'.format(name,proc.pid))
+        self.processes[index] = (name,proc)
+        self.status.pop(name,None)
+        self.drain.add(name,proc)
+
+    def terminate_later(self, processes, timeout=10., done=None):
+        """Like terminate, but waits from the loop instead of blocking it
+
+        done is called without arguments once all groups are gone.
+        """
+        alive = [(name,proc) for name,proc in processes if _group_alive(proc)]
+        for name,proc in alive:
+            _killpg(proc,signal.SIGTERM)
+        deadline = time.time()+timeout
+        def check(alive):
+            alive = [(name,proc) for name,proc in alive if _group_alive(proc)]
+            if alive and time.time() < deadline:
+                self.call_later(0.05,lambda: check(alive))
+                return
+            for name,proc in alive:
+                logger.warning('{0} (pid {1}) did not terminate within {2}s, killing'.format(
+                    name,proc.pid,timeout))
+                _killpg(proc,signal.SIGKILL)
+            for name,proc in alive:
+                proc.wait()
+            if done is not None:
+                done()
+        check(alive)
+
+    def install(self):
+        """Install the signal handlers, must be called from the main thread"""
+        r,w = os.pipe()
+        _set_nonblocking(r)
+        _set_nonblocking(w)
+        self._wakeup = (r,w)
+        self.poller.register(r,select.EPOLLIN)
+        signal.set_wakeup_fd(w)
+        def handler(signum, frame):
+            self._signals.append(signum)
+        for sig in self.STOP_SIGNALS+(signal.SIGCHLD,):
+            self._handlers[sig] = signal.signal(sig,handler)
+
+    def uninstall(self):
+        if self._wakeup is None:
+            return
+        for sig,old in self._handlers.items():
+            signal.signal(sig,old)
+        self._handlers = {}
+        signal.set_wakeup_fd(-1)
+        self.poller.unregister(self._wakeup[0])
+        for fd in self._wakeup:
+            os.close(fd)
+        self._wakeup = None
+
+    def reap(self):
+        # on_exit may discard processes, the daemon does when a session stops
+        for name,proc in list(self.processes):
+            if name not in self.status and proc.poll() is not None:
+                self.status[name] = proc.returncode
+                logger.info('{0} (pid {1}) {2}'.format(
+                    name,proc.pid,describe_status(proc.returncode)))
+                self.on_exit(name,proc)
+
+    def _handle_signals(self):
+        try:
+            while os.read(self._wakeup[0],512):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN,errno.EINTR):
+                raise
+        while self._signals:
+            signum = self._signals.popleft()
+            if signum == signal.SIGCHLD:
+                self.reap()
+            else:
+                self.stop('received {0}'.format(signal_name(signum)))
+
+    def _next_timeout(self):
+        if not self._timers:
+            return -1
+        return max(self._timers[0][0]-time.time(),0)
+
+    def run_once(self, timeout=None):
+        """Wait for and handle one round of events
+
+        Without timeout waits until the next timer is due or an event arrives.
+        """
+        due = self._next_timeout()
+        if timeout is None or (due >= 0 and due < timeout):
+            timeout = due
+        try:
+            events = self.poller.poll(timeout)
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            events = []
+        for fd,flags in events:
+            if self._wakeup is not None and fd == self._wakeup[0]:
+                continue
+            if fd in self._readers:
+                self._readers[fd](fd,flags)
+            else:
+                self.drain.handle(fd,flags)
+        if self._wakeup is not None:
+            self._handle_signals()
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            when,count,callback = heapq.heappop(self._timers)
+            callback()
+
+    def run(self):
+        """Run until stopped, returns the reason"""
+        # children which exited before the handler was installed
+        self.reap()
+        while self.reason is None:
+            self.run_once()
+        return self.reason
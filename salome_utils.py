@@ -18,6 +18,11 @@ __all__ = [
     'generateFileName',
     'getCacheDir',
     'getConfigDir',
+    'getRuntimeDir',
+    'getLauncherCacheDir',
+    'getSessionCacheFile',
+    'removeFiles',
+    'isProcessAlive',
     ]
 
 def _try_bool( arg ):
@@ -317,6 +322,59 @@ def getCacheDir():
     else:
         return os.getenv('XDG_CACHE_HOME','.cache')
 
+def getRuntimeDir():
+    """
+    Get directory for the runtime files of the running sessions, preferably
+    on a tmpfs: XDG_RUNTIME_DIR, /dev/shm or the temporary directory.
+    """
+    import sys
+    if sys.platform == "win32":
+        return getTmpDir()
+    runtime = os.getenv('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return runtime
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    return getTmpDir()
+
+def getLauncherCacheDir():
+    """
+    Get the cache directory of the launcher, created if missing.
+    """
+    path = os.path.join(getCacheDir(),'salome_launcher')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def getSessionCacheFile(host, port, suffix='.json'):
+    """
+    Get the path of a file belonging to the session host:port in the cache
+    directory of the launcher.
+    """
+    return os.path.join(getLauncherCacheDir(),'{0}:{1}{2}'.format(host,port,suffix))
+
+def removeFiles(paths):
+    """
+    Remove the files and directory trees, missing ones are skipped.
+    """
+    import shutil
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+
+def isProcessAlive(pid):
+    """
+    Check if the process exists, also if it belongs to another user.
+    """
+    import errno
+    try:
+        os.kill(pid,0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
 def uniteFiles( src_file, dest_file ):
     """
     Unite contents of the source file with contents of the destination file
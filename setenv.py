@@ -4,50 +4,386 @@
 
 import sys
 import os
+import mmap
 import glob
+import logging
 import time
+import json
 import pickle
+import errno
+import stat
+import struct
+import hashlib
 import subprocess
 
+try:
+    from pipes import quote as _quote
+except ImportError:
+    from shlex import quote as _quote
+
 from salome_utils import *
-from lxml import etree
-from lxml.builder import E
+from salome_profile import timeline
 from collections import Iterable
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport for python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger('salome')
+
 # salome_subdir variable is used for composing paths like
 # $KERNEL_ROOT_DIR/share/salome/resources, etc.  before moving to SUIT-based
 # gui, instead of salome_subdir there was args['appname'] used.  but after -
 # 'appname'  = "SalomeApp", so using it in making the subdirectory is an error.
 salome_subdir = "salome"
 
+# threads used to scan directories, on nfs every stat is a round trip
+SCAN_THREADS = 16
+
+# modules every session needs, whatever modules were asked for
+BASE_MODULES = ('KERNEL','GUI')
+
+# variables which are lists of directories, changes to them are merged with
+# the value of the environment they are applied to
+PATH_VARIABLES = ('PATH','LD_LIBRARY_PATH','PYTHONPATH','MANPATH',
+                  'PKG_CONFIG_PATH','SalomeAppConfig')
+
+
+def list_dirs(path):
+    """Names of the sub directories of path, [] if path is no directory
+
+    With scandir the file type comes from the directory entry itself, so no
+    extra stat is needed per entry.
+    """
+    try:
+        if scandir is not None:
+            return [x.name for x in scandir(path) if x.is_dir()]
+        return [x for x in os.listdir(path)
+                if os.path.isdir(os.path.join(path,x))]
+    except OSError:
+        return []
+
+def parallel_map(func, items):
+    """map in a thread pool, the order of the results is kept"""
+    items = list(items)
+    if len(items) < 2:
+        return [func(x) for x in items]
+    # imported here, it is slow to import and only the scans need it
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(len(items),SCAN_THREADS))
+    try:
+        return pool.map(func,items)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def collect_module_data(modules_path):
     data = {}
     python_version="python%d.%d" % sys.version_info[0:2]
-    for x in os.listdir(modules_path):
-        if os.path.isdir(os.path.join(modules_path,x)):
-            name = x.split('_')[0]
-            root = os.path.join(modules_path,x)
-            site = os.path.join(
-                root,'lib',python_version,'site-packages','salome')
-            resources = os.path.join(
-                root,'share','salome','resources',name.lower())
-            bindir = os.path.join(root,'bin','salome')
-            data[name] = {
-                'root':os.path.abspath(root),
-                'bin':os.path.abspath(bindir),
-                'lib':os.path.abspath(os.path.join(root,'lib','salome')),
-                'site-packages':os.path.abspath(site),
-                'shared_modules':os.path.abspath(os.path.join(site,'shared_modules')),
-                'resources':os.path.abspath(resources),
-                #if not name.lower().endswith('plugin'):
-                'catalog':os.path.abspath(os.path.join(resources,'%sCatalog.xml'%name)),
-            }
+    for x in list_dirs(modules_path):
+        name = x.split('_')[0]
+        root = os.path.join(modules_path,x)
+        site = os.path.join(
+            root,'lib',python_version,'site-packages','salome')
+        resources = os.path.join(
+            root,'share','salome','resources',name.lower())
+        bindir = os.path.join(root,'bin','salome')
+        data[name] = {
+            'root':os.path.abspath(root),
+            'bin':os.path.abspath(bindir),
+            'lib':os.path.abspath(os.path.join(root,'lib','salome')),
+            'site-packages':os.path.abspath(site),
+            'shared_modules':os.path.abspath(os.path.join(site,'shared_modules')),
+            'resources':os.path.abspath(resources),
+            #if not name.lower().endswith('plugin'):
+            'catalog':os.path.abspath(os.path.join(resources,'%sCatalog.xml'%name)),
+        }
+
+    return data
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _collect_modules_indexed(modules_path, index):
+    """collect_module_data, reused from the index if the tree didn't change"""
+    mtime = _mtime(modules_path)
+    entry = index.get('modules')
+    if entry and entry['path'] == modules_path and entry['mtime'] == mtime:
+        return entry['data']
+    data = collect_module_data(modules_path)
+    index['modules'] = {'path':modules_path,'mtime':mtime,'data':data}
     return data
 
-def create_config_template(modules_path,prereq_paths=[]):
-    modules = collect_module_data(modules_path)
+def elf_needed(path):
+    """Names of the libraries an ELF file links against (DT_NEEDED)
+
+    Returns [] for files which are no ELF files or have no dynamic section.
+    """
+    with open(path,'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b'\x7fELF':
+            return []
+        is64 = ident[4:5] == b'\x02'
+        e = '<' if ident[5:6] == b'\x01' else '>'
+        if is64:
+            header = struct.unpack(e+'HHIQQQIHHHHHH',f.read(48))
+            shfmt,dynfmt = e+'IIQQQQIIQQ',e+'qQ'
+        else:
+            header = struct.unpack(e+'HHIIIIIHHHHHH',f.read(36))
+            shfmt,dynfmt = e+'IIIIIIIIII',e+'iI'
+        shoff,shentsize,shnum = header[5],header[10],header[11]
+        sections = []
+        for i in range(shnum):
+            f.seek(shoff+i*shentsize)
+            sections.append(struct.unpack(shfmt,f.read(struct.calcsize(shfmt))))
+        needed = []
+        for section in sections:
+            # SHT_DYNAMIC, its link is the string table
+            if section[1] != 6:
+                continue
+            f.seek(section[4])
+            data = f.read(section[5])
+            strtab = sections[section[6]]
+            f.seek(strtab[4])
+            strings = f.read(strtab[5])
+            size = struct.calcsize(dynfmt)
+            for offset in range(0,len(data)-size+1,size):
+                tag,value = struct.unpack(dynfmt,data[offset:offset+size])
+                if tag == 0:
+                    break
+                if tag == 1:
+                    name = strings[value:strings.index(b'\0',value)]
+                    needed.append(name.decode('utf-8'))
+        return needed
+
+def _libraries(libdir):
+    try:
+        names = os.listdir(libdir)
+    except OSError:
+        return []
+    return [os.path.join(libdir,x) for x in sorted(names)
+            if x.endswith('.so') or '.so.' in x]
+
+def detect_requires(modules, index=None):
+    """Modules every module needs, detected from its libraries
+
+    A module requires another one if one of its libraries links against a
+    library in the lib directory of the other one.
+    :index: dict like for create_config_template, modules whose lib directory
+        did not change are not read again
+    """
+    cache = index.setdefault('requires',{}) if index is not None else {}
+    provider = {}
+    libraries = {}
+    for name,val in sorted(modules.items()):
+        libraries[name] = _libraries(val['lib'])
+        for path in libraries[name]:
+            provider.setdefault(os.path.basename(path),name)
+
+    def scan(name):
+        libdir = modules[name]['lib']
+        mtime = _mtime(libdir)
+        hit = cache.get(name)
+        if hit is not None and hit['lib'] == libdir and hit['mtime'] == mtime:
+            return hit
+        needed = set()
+        for path in libraries[name]:
+            try:
+                needed.update(elf_needed(path))
+            except (IOError,struct.error,ValueError,IndexError) as e:
+                logger.debug('failed to read {0}: {1}'.format(path,e))
+        return {'lib':libdir,'mtime':mtime,'needed':sorted(needed)}
+
+    names = sorted(modules)
+    results = parallel_map(scan,names)
+    cache.clear()
+    requires = {}
+    for name,result in zip(names,results):
+        cache[name] = result
+        requires[name] = sorted(set(
+            provider[x] for x in result['needed'] if x in provider)-set([name]))
+    return requires
+
+def module_closure(config, modules):
+    """Names of the modules and of all modules they require, transitively
+
+    What a module requires is given by the list 'requires' of its config,
+    detected when the config is created and extendable by hand. Configs
+    created before have no such list, for them all modules are used.
+    """
+    available = dict((x.upper(),x) for x in config['modules'])
+    pending = list(BASE_MODULES)+list(modules)
+    result = set()
+    while pending:
+        name = available.get(pending.pop().upper())
+        if name is None or name in result:
+            continue
+        if 'requires' not in config['modules'][name]:
+            logger.warning('the config lacks the requirements of {0}, using all '
+                           'modules, update it with --update'.format(name))
+            return set(config['modules'])
+        result.add(name)
+        pending.extend(config['modules'][name]['requires'])
+    return result
+
+def build_lib_farm(config, path, index=None):
+    """Symlink the libraries of all library directories of the config into path
+
+    The directories are the LD_LIBRARY_PATH of the prerequisites followed by
+    the lib directories of the modules, KERNEL first, like they take
+    precedence in the environment. Of libraries with the same name in several
+    directories the first one wins, the others are reported as conflicts.
+    Directories which did not change according to the index are not listed
+    again and only links which changed are touched.
+    Returns the lib_farm entry of the config, with it set_env uses path
+    instead of the directories which did not change since.
+    """
+    cache = index.setdefault('lib_farm',{}) if index is not None else {}
+    dirs = list(config.get('env',{}).get('LD_LIBRARY_PATH',[]))
+    for name in sorted(config['modules'],key=lambda x:(x.upper() != 'KERNEL',x)):
+        libdir = config['modules'][name]['lib']
+        if libdir not in dirs:
+            dirs.append(libdir)
+
+    def scan(directory):
+        mtime = _mtime(directory)
+        hit = cache.get(directory)
+        if hit is not None and hit['mtime'] == mtime:
+            return hit
+        return {'mtime':mtime,
+                'names':[os.path.basename(x) for x in _libraries(directory)]}
+
+    results = parallel_map(scan,dirs)
+    cache.clear()
+    wanted = {}
+    conflicts = {}
+    for directory,result in zip(dirs,results):
+        cache[directory] = result
+        for name in result['names']:
+            target = os.path.join(directory,name)
+            if name not in wanted:
+                wanted[name] = target
+            elif os.path.realpath(target) != os.path.realpath(wanted[name]):
+                conflicts.setdefault(name,[wanted[name]]).append(target)
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    existing = {}
+    for name in os.listdir(path):
+        if os.path.islink(os.path.join(path,name)):
+            existing[name] = os.readlink(os.path.join(path,name))
+    for name,target in existing.items():
+        if wanted.get(name) != target:
+            os.remove(os.path.join(path,name))
+    for name,target in sorted(wanted.items()):
+        if existing.get(name) != target:
+            try:
+                os.symlink(target,os.path.join(path,name))
+            except OSError as e:
+                logger.warning('failed to link {0}: {1}'.format(name,e))
+    for name,targets in sorted(conflicts.items()):
+        logger.warning('{0} is in {1}, using {2}'.format(
+            name,', '.join(os.path.dirname(x) for x in targets),
+            os.path.dirname(targets[0])))
+    return {'path':path,'dirs':dirs,'conflicts':conflicts,
+            'mtimes':dict((x,cache[x]['mtime']) for x in dirs)}
+
+def python_dirs(config):
+    """The PYTHONPATH directories set_env adds for the config"""
+    dirs = list(config.get('env',{}).get('PYTHONPATH',[]))
+    for name in sorted(config['modules']):
+        for key in ('shared_modules','site-packages','lib','bin'):
+            directory = config['modules'][name][key]
+            if directory not in dirs:
+                dirs.append(directory)
+    return dirs
+
+def build_import_index(config, path, index=None):
+    """Index the top level python modules of all python directories of the config
+
+    path becomes a directory with the index.json and a copy of
+    salome_importindex as sitecustomize.py, with it on the PYTHONPATH every
+    python process finds the top level modules of these directories without
+    searching them one by one. Names which are modules or regular packages in
+    more than one directory are reported as conflicts. Directories which did
+    not change according to the index are not listed again.
+    Returns the import_index entry of the config.
+    """
+    import shutil
+    import salome_importindex
+    cache = index.setdefault('import_index',{}) if index is not None else {}
+    dirs = python_dirs(config)
+
+    def scan(directory):
+        mtime = _mtime(directory)
+        hit = cache.get(directory)
+        if hit is not None and hit['mtime'] == mtime:
+            return hit
+        return {'mtime':mtime,
+                'names':salome_importindex.top_level_names(directory)}
+
+    results = parallel_map(scan,dirs)
+    cache.clear()
+    modules = {}
+    regular = set()
+    for directory,result in zip(dirs,results):
+        cache[directory] = result
+        for name,isregular in result['names'].items():
+            modules.setdefault(name,[]).append(directory)
+            if isregular:
+                regular.add(name)
+    conflicts = dict((name,found) for name,found in modules.items()
+                     if len(found) > 1 and name in regular)
+    for name,found in sorted(conflicts.items()):
+        logger.warning('python module {0} is in {1}'.format(
+            name,', '.join(found)))
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    tmp = os.path.join(path,'index.json.tmp')
+    with open(tmp,'w') as store:
+        json.dump({
+            'dirs':dirs,
+            'mtimes':dict((x,cache[x]['mtime']) for x in dirs),
+            'modules':modules,
+        },store)
+    os.rename(tmp,os.path.join(path,'index.json'))
+    source = os.path.splitext(salome_importindex.__file__)[0]+'.py'
+    shutil.copyfile(source,os.path.join(path,'sitecustomize.py'))
+    return {'path':path,'conflicts':conflicts}
+
+def create_config_template(modules_path,prereq_paths=[],index=None):
+    """Create the config of the modules and prerequisites
+
+    :index: dict with the state of the scanned directories and files, updated
+        in place, pass the one of a previous run to rescan only what changed
+    """
+    if index is None:
+        index = {}
+    prereq_index = index.setdefault('prereqs',{})
+    # the modules and all prerequisite paths are scanned concurrently
+    scans = parallel_map(
+        lambda x: x[0](*x[1:]),
+        [(_collect_modules_indexed,modules_path,index)]+
+        [(get_prerequisites,path,prereq_index.setdefault(path,{}))
+         for path in prereq_paths])
+    # forget prerequisite paths which are not used anymore
+    for path in list(prereq_index):
+        if path not in prereq_paths:
+            del prereq_index[path]
+    # a copy, the data of the index stays as scanned
+    modules = dict((k,dict(v)) for k,v in scans[0].items())
+    for name,requires in detect_requires(modules,index).items():
+        modules[name]['requires'] = requires
     config = {
         'env':{
             # SMESH expects a environment variable describing the meshers, lets create
@@ -58,8 +394,7 @@ def create_config_template(modules_path,prereq_paths=[]):
         },
         'modules':modules,
     }
-    for path in prereq_paths:
-        add_config = get_prerequisites(path)
+    for add_config in scans[1:]:
         for key,data in add_config.items():
             if key in config['env']:
                 config['env'][key].extend(data)
@@ -67,96 +402,423 @@ def create_config_template(modules_path,prereq_paths=[]):
                 config['env'][key] = data
     return config
 
-def get_prerequisites(prereqpath):
+def merge_config(current, previous, generated):
+    """Three way merge of a regenerated config
+
+    Whatever is in current like it was generated previously is replaced by
+    the newly generated value, hand edits are kept. Of lists the hand added
+    entries are kept, the generated ones updated.
+    """
+    if isinstance(current,dict) and isinstance(generated,dict):
+        previous = previous if isinstance(previous,dict) else {}
+        result = {}
+        for key in set(current)|set(generated):
+            if key not in current:
+                if key not in previous:
+                    result[key] = generated[key]
+                # else removed by hand
+            elif key not in generated:
+                if key not in previous or current[key] != previous[key]:
+                    result[key] = current[key]
+                # else not generated anymore
+            else:
+                result[key] = merge_config(
+                    current[key],previous.get(key),generated[key])
+        return result
+    if current == previous:
+        return generated
+    if isinstance(current,list) and isinstance(generated,list):
+        previous = previous if isinstance(previous,list) else []
+        return [x for x in current if x in generated or x not in previous]+\
+            [x for x in generated if x not in current]
+    return current
+
+def _scan_prerequisite(args):
+    prereqpath,prereq,cache = args
+    python_version="python%d.%d" % sys.version_info[0:2]
+    root = os.path.join(prereqpath,prereq)
+    libdir = os.path.join(root,'lib')
+    # the result only depends on the listings of these directories
+    state = [_mtime(x) for x in (root,libdir,os.path.join(libdir,python_version))]
+    hit = cache.get(prereq)
+    if hit is not None and hit['state'] == state:
+        return hit['result']
     ld_library_path = []
     path = []
-    include = []
     pythonpath = []
-    python_version="python%d.%d" % sys.version_info[0:2]
-    for prereq in os.listdir(prereqpath):
-        libdir = os.path.join(prereqpath,prereq,'lib')
-        if os.path.isdir(libdir):
-            for sub in os.listdir(libdir):
-                if os.path.isdir(os.path.join(libdir,sub)) and prereq.split('_')[0].lower() in sub:
-                    ld_library_path.append(
-                        os.path.abspath(os.path.join(libdir,sub)))
-            ld_library_path.append(os.path.abspath(libdir))
-        if os.path.isdir(os.path.join(
-            prereqpath,prereq,'lib',python_version,'site-packages')):
+    subdirs = list_dirs(root)
+    if 'lib' in subdirs:
+        libsubdirs = list_dirs(libdir)
+        for sub in libsubdirs:
+            if prereq.split('_')[0].lower() in sub:
+                ld_library_path.append(
+                    os.path.abspath(os.path.join(libdir,sub)))
+        ld_library_path.append(os.path.abspath(libdir))
+        if python_version in libsubdirs and 'site-packages' in list_dirs(
+                os.path.join(libdir,python_version)):
             pythonpath.append(os.path.abspath(os.path.join(
-                prereqpath,prereq,'lib',python_version,'site-packages')))
-        if os.path.isdir(os.path.join(prereqpath,prereq,'bin')):
-            path.append(os.path.abspath(os.path.join(prereqpath,prereq,'bin')))
+                libdir,python_version,'site-packages')))
+    if 'bin' in subdirs:
+        path.append(os.path.abspath(os.path.join(root,'bin')))
+    result = [ld_library_path,path,pythonpath]
+    cache[prereq] = {'state':state,'result':result}
+    return result
+
+def get_prerequisites(prereqpath,cache=None):
+    """Paths of the prerequisites installed in prereqpath
+
+    :cache: dict updated in place, prerequisites whose directories didn't
+        change since the run which filled it are not scanned again
+    """
+    if cache is None:
+        cache = {}
+    mtime = _mtime(prereqpath)
+    if cache.get('mtime') == mtime and 'names' in cache:
+        names = cache['names']
+    else:
+        names = list_dirs(prereqpath)
+    entries = cache.setdefault('entries',{})
+    for name in list(entries):
+        if name not in names:
+            del entries[name]
+    ld_library_path = []
+    path = []
+    pythonpath = []
+    for ld,p,py in parallel_map(
+            _scan_prerequisite,[(prereqpath,x,entries) for x in names]):
+        ld_library_path.extend(ld)
+        path.extend(p)
+        pythonpath.extend(py)
+    cache['mtime'] = mtime
+    cache['names'] = names
     return {
         'LD_LIBRARY_PATH':ld_library_path,
         'PATH':path,
         'PYTHONPATH':pythonpath,
     }
 
-def get_meshers(modules_config):
+def _find_meshers_group(xmlpath):
+    """resources of the meshers-group element below the root, None if missing
+
+    Files which don't even contain the name are skipped without parsing,
+    the others are parsed incrementally only up to the element.
+    """
+    from lxml import etree
+    with open(xmlpath,'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return None
+        try:
+            if data.find(b'meshers-group') < 0:
+                return None
+        finally:
+            data.close()
+    depth = 0
+    try:
+        for event,element in etree.iterparse(xmlpath,events=('start','end')):
+            if event == 'end':
+                depth -= 1
+                continue
+            depth += 1
+            if depth == 2 and element.tag == 'meshers-group':
+                return element.get('resources')
+    except etree.XMLSyntaxError as e:
+        logger.warning('failed to parse {0}: {1}'.format(xmlpath,e))
+    return None
+
+def get_meshers(modules_config,cache=None):
+    """Resources of the mesher plugins of all modules
+
+    :cache: dict mapping every xml file to its mtime, size and result,
+        unchanged files are not parsed again. By default it is kept in the
+        cache directory, shared by the templates of all installs.
+    """
+    cachefile = None
+    if cache is None:
+        cachefile = os.path.join(getCacheDir(),'salome_launcher','meshers.json')
+        try:
+            with open(cachefile,'r') as store:
+                cache = json.load(store)
+        except (IOError,ValueError):
+            cache = {}
+    patterns = [os.path.join(val['resources'],'*.xml')
+                for key,val in sorted(modules_config.items())]
+    xmlpaths = []
+    for pattern in patterns:
+        xmlpaths.extend(sorted(glob.glob(pattern)))
+
+    def scan(xmlpath):
+        try:
+            st = os.stat(xmlpath)
+        except OSError:
+            return None
+        hit = cache.get(xmlpath)
+        if hit is not None and hit['mtime'] == st.st_mtime and \
+           hit['size'] == st.st_size:
+            return hit
+        return {'mtime':st.st_mtime,'size':st.st_size,
+                'resources':_find_meshers_group(xmlpath)}
+
+    # lxml releases the gil while parsing, so the files are done in parallel
+    results = parallel_map(scan,xmlpaths)
+    # only the entries of the scanned directories are replaced, the ones of
+    # other installs stay
+    scanned = set(os.path.dirname(x) for x in patterns)
+    for xmlpath in list(cache):
+        if os.path.dirname(xmlpath) in scanned:
+            del cache[xmlpath]
     meshers = []
-    for key,val in modules_config.items():
-        for xmlpath in glob.glob(
-            os.path.join(val['resources'],'*.xml')):
-            try:
-                doc = etree.parse(xmlpath)
-                gr = doc.find('meshers-group')
-                if gr != None:
-                    meshers.append(gr.get('resources'))
-            except etree.XMLSyntaxError as e:
-                pass
+    for xmlpath,result in zip(xmlpaths,results):
+        if result is None:
+            continue
+        cache[xmlpath] = result
+        if result['resources'] is not None:
+            meshers.append(result['resources'])
+    if cachefile is not None:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        # templates may be generated concurrently
+        tmp = '{0}.{1}.tmp'.format(cachefile,os.getpid())
+        with open(tmp,'w') as store:
+            json.dump(cache,store)
+        os.rename(tmp,cachefile)
     return meshers
 
+def _catalog_key(item):
+    name = item.get('name')
+    if name is None:
+        for child in item:
+            if not callable(child.tag) and child.tag.endswith('-name'):
+                return (child.text or '').strip()
+    return name
+
+def merge_catalogs(paths,output):
+    """Merge module catalogs into one file
+
+    The children of the sections like type-list or component-list of all
+    catalogs are concatenated, of types and components with the same name
+    the first one wins. Broken catalogs are skipped.
+    """
+    from lxml import etree
+    parser = etree.XMLParser(remove_blank_text=True)
+    root = None
+    seen = set()
+    for path in paths:
+        try:
+            tree = etree.parse(path,parser)
+        except etree.XMLSyntaxError as e:
+            logger.warning('failed to parse the catalog {0}: {1}'.format(path,e))
+            continue
+        if root is None:
+            root = etree.Element(tree.getroot().tag)
+        for section in tree.getroot():
+            # comments and processing instructions
+            if callable(section.tag):
+                continue
+            target = root.find(section.tag)
+            if target is None:
+                target = etree.SubElement(root,section.tag,dict(section.attrib))
+            for item in list(section):
+                if callable(item.tag):
+                    continue
+                if section.tag in ('type-list','component-list'):
+                    key = (section.tag,_catalog_key(item))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                target.append(item)
+    if root is None:
+        return False
+    tmp = '{0}.{1}.tmp'.format(output,os.getpid())
+    etree.ElementTree(root).write(
+        tmp,xml_declaration=True,encoding='utf-8',pretty_print=True)
+    os.rename(tmp,output)
+    return True
+
+def prepare_catalogs(modules_config,modules,cachedir=None):
+    """Catalogs for the ModuleCatalog server of a session with the modules
+
+    Only the existing catalogs of the modules and of KERNEL are used, merged
+    into one file, which is cached in cachedir under the hash of the paths and
+    mtimes of the inputs. So ModuleCatalog parses a single file and it is only
+    merged again if one of the catalogs changed. Returns the list of catalogs
+    to pass, the unmerged ones if merging fails.
+    """
+    names = set(x.upper() for x in modules)
+    names.add('KERNEL')
+    paths = []
+    # KERNEL first, it defines the basic types
+    for name,val in sorted(modules_config.items(),
+                           key=lambda x:(x[0].upper() != 'KERNEL',x[0])):
+        catalog = val.get('catalog')
+        if name.upper() not in names or not catalog:
+            continue
+        if not os.path.isfile(catalog):
+            logger.debug('no catalog {0} for {1}'.format(catalog,name))
+            continue
+        paths.append(catalog)
+    if len(paths) < 2:
+        return paths
+    key = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        key.update('{0}\0{1}\0{2}\0'.format(
+            path,st.st_mtime,st.st_size).encode('utf-8'))
+    if cachedir is None:
+        cachedir = os.path.join(getCacheDir(),'salome_launcher','catalogs')
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    merged = os.path.join(cachedir,'{0}.xml'.format(key.hexdigest()))
+    if os.path.isfile(merged):
+        return [merged]
+    try:
+        if merge_catalogs(paths,merged):
+            return [merged]
+    except (ImportError,IOError,OSError) as e:
+        logger.warning('failed to merge the catalogs: {0}'.format(e))
+    return paths
+
+def _directories(directory):
+    if isinstance(directory,Iterable) and not isinstance(directory,(str,unicode)):
+        return list(directory)
+    return [directory]
+
+
+class PathList(object):
+    """Ordered set of the directories added to one PATH like variable
+
+    As with repeated add_path calls, directories added later end up in front
+    of the ones added before, and all of them in front of the current value.
+    Membership is checked against whole entries, so a directory is never
+    mistaken as present because it is a prefix of another one.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.seen = set()
+
+    def add(self, directories):
+        """Add the directories, return the ones which were new"""
+        new = []
+        for _dir in directories:
+            if _dir and _dir not in self.seen:
+                self.seen.add(_dir)
+                new.append(_dir)
+        if new:
+            self.chunks.append(new)
+        return new
+
+    def entries(self, current=''):
+        """The entries of the variable with current as the previous value
+
+        Directories already in current keep their position there.
+        """
+        current = [x for x in current.split(os.pathsep) if x]
+        present = set(current)
+        return [x for chunk in reversed(self.chunks) for x in chunk
+                if x not in present]+current
+
+
+class EnvBuilder(object):
+    """Collect PATH like variables and write each of them only once
+
+    PYTHONPATH entries also go to sys.path right away, so the <module>_setenv
+    modules can be imported before commit.
+    """
+
+    def __init__(self):
+        self.paths = {}
+
+    def add_path(self, directory, variable_name):
+        if variable_name not in self.paths:
+            self.paths[variable_name] = PathList()
+        new = self.paths[variable_name].add(_directories(directory))
+        if variable_name == "PYTHONPATH":
+            for _dir in reversed(new):
+                if _dir not in sys.path:
+                    sys.path.insert(0,_dir)
+
+    def commit(self):
+        """Write the variables, keeping whatever was set meanwhile
+
+        Returns the names of the variables written.
+        """
+        for variable_name,pathlist in self.paths.items():
+            os.environ[variable_name] = os.pathsep.join(
+                pathlist.entries(os.environ.get(variable_name,'')))
+        names = sorted(self.paths)
+        self.paths = {}
+        return names
+
 def add_path(directory, variable_name):
     """Function helper to add environment variables"""
-    if not variable_name in os.environ:
-        os.environ[variable_name] = ""
-    if isinstance(directory,Iterable) and not isinstance(directory,unicode):
-        directories=list(directory)
-    else:
-        directories=[directory]
-    toappend = []
-    for _dir in directories:
-        if not _dir in os.environ[variable_name]:
-            toappend.append(_dir)
-    os.environ[variable_name] = (
-        os.pathsep.join(toappend)+os.pathsep+os.environ[variable_name])
-    ## to clever in my opinion, but maybe it depends on it
-    if variable_name == "PYTHONPATH":
-        sys.path.insert(0,directory)
+    builder = EnvBuilder()
+    builder.add_path(directory,variable_name)
+    builder.commit()
 
 def get_lib_dir():
     return 'lib'
 
-def set_env(config, args={},silent=False):
+def set_env(config, args={},silent=False,modules=None):
     """Add to the PATH-variables modules specific paths and set all other left
     environment variables specific to the salome application
 
     :args: dict containing additional agrs, see the source code to get a clue
             what we support here
+    :modules: only set up these modules, the ones they require and the
+            BASE_MODULES, by default all modules of the config
     :modules_list: list of modules which need to be loaded
     :modules_config: a tuple of (name,module_config) of the module
             configurations
+
+    Returns the names of the PATH like variables it wrote, see
+    save_env_snapshot.
     """
-    # source a shell script
+    # source the shell scripts, all of them at once
     if 'env_sh' in config:
         if isinstance(config['env_sh'],Iterable) and \
            not isinstance(config['env_sh'],unicode):
-            for path in config['env_sh']:
-                source_shell_script(path)
+            paths = config['env_sh']
         else:
-            source_shell_script(config['env_sh'])
+            paths = [config['env_sh']]
+        with timeline.phase('source {0}'.format(' '.join(paths))):
+            source_shell_scripts(paths)
     module_root_dirs = set()
     module_resources = set()
+    # the path variables are collected and written once at the end
+    env = EnvBuilder()
+    add_path = env.add_path
     # smesh_setenv assumes it is defined already
-    add_path('','SalomeAppConfig')
-    for module, module_config in config['modules'].items():
+    os.environ.setdefault('SalomeAppConfig','')
+    # the lib farm replaces all the library directories it links
+    farm = config.get('lib_farm')
+    if farm and not os.path.isdir(farm['path']):
+        logger.warning('lib farm {0} is missing'.format(farm['path']))
+        farm = None
+    farmed = set()
+    if farm:
+        # a directory changed since the farm was built is used itself, the
+        # farm may lack its new libraries
+        mtimes = farm.get('mtimes',{})
+        for directory in farm['dirs']:
+            if _mtime(directory) == mtimes.get(directory):
+                farmed.add(directory)
+            else:
+                logger.warning('{0} changed since the lib farm was built, '
+                               'rebuild it with --update'.format(directory))
+    selected = config['modules']
+    if modules is not None:
+        names = module_closure(config,modules)
+        selected = dict((k,v) for k,v in selected.items() if k in names)
+    for module, module_config in selected.items():
         os.environ['%s_ROOT_DIR'%module.upper()] = module_config['root']
         module_root_dirs.add(module_config['root'])
         module_resources.add(module_config['resources'])
         if sys.platform == "win32":
             add_path(module_config['lib'],"PATH")
-        else:
+        elif module_config['lib'] not in farmed:
             add_path(module_config['lib'],"LD_LIBRARY_PATH")
         add_path(module_config['bin'],"PATH")
         # add lib before site-packages to load script instead of dll if any
@@ -168,8 +830,9 @@ def set_env(config, args={},silent=False):
 
         # set environment by modules from the list
         try:
-            mod = __import__(module.lower()+"_setenv")
-            mod.set_env([])
+            with timeline.phase(module.lower()+'_setenv'):
+                mod = __import__(module.lower()+"_setenv")
+                mod.set_env([])
         except ImportError:
             pass
         except Exception as e:
@@ -179,7 +842,7 @@ def set_env(config, args={},silent=False):
             #traceback.print_exc()
 
     if os.getenv('SALOME_BATCH') == None:
-        os.putenv('SALOME_BATCH','0')
+        os.environ['SALOME_BATCH'] = '0'
     # probably needed, i don't know
     os.environ["SALOMEPATH"]=os.pathsep.join(module_root_dirs)
     # set trace environment variable
@@ -202,13 +865,65 @@ def set_env(config, args={},silent=False):
     if 'env' in config:
         for key,val in config['env'].items():
             if isinstance(val,list):
+                if key == 'LD_LIBRARY_PATH':
+                    val = [x for x in val if x not in farmed]
                 add_path(val,key)
             else:
                 os.environ[key] = val
+    if farm:
+        add_path(farm['path'],'LD_LIBRARY_PATH')
+    # in front of the indexed directories, its sitecustomize installs the
+    # finder in the python processes of the session
+    imports = config.get('import_index')
+    if imports and os.path.isdir(imports['path']):
+        add_path(imports['path'],'PYTHONPATH')
+    else:
+        imports = None
+    paths = env.commit()
+    if imports:
+        import salome_importindex
+        salome_importindex.install(os.path.join(imports['path'],'index.json'))
+    return paths
+
+def _makedir(path, mode=0o700):
+    """Create a private directory, refuse an existing one others could use
+
+    The runtime directories live in directories shared with the other
+    users, one of them could have created it before.
+    """
+    try:
+        os.mkdir(path,mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+       st.st_mode & 0o077:
+        raise RuntimeError('refusing to use {0}, it must be a directory owned '
+                           'by you without permissions for others'.format(path))
+
+def _runtime_userdir():
+    return os.path.join(getRuntimeDir(),'salome_launcher-{0}'.format(os.getuid()))
+
+def runtime_dir(host,port):
+    """Directory for the runtime files of the session, IORs, logs and cfg
+
+    It is the same for every call with host and port, make_runtime_dir
+    creates it for the session, the launcher removes it when the session ends.
+    """
+    return os.path.join(_runtime_userdir(),'{0}:{1}'.format(host,port))
+
+def make_runtime_dir(host,port):
+    """Create the runtime_dir of the session and return it"""
+    # /dev/shm and the temporary directory are shared with the other users
+    _makedir(_runtime_userdir())
+    path = runtime_dir(host,port)
+    _makedir(path)
+    return path
 
 def set_env_omniorb(host,port,omniorb_userpath=None):
     if not omniorb_userpath:
-        omniorb_userpath = os.path.join(getCacheDir(),'omniORB')
+        omniorb_userpath = runtime_dir(host,port)
     os.environ['OMNIORB_USER_PATH'] = omniorb_userpath
     os.environ['OMNIORB_CONFIG'] = os.path.join(
         os.environ['OMNIORB_USER_PATH'],'omniORB_{0}_{1}.cfg'.format(host,port))
@@ -216,9 +931,244 @@ def set_env_omniorb(host,port,omniorb_userpath=None):
     os.environ['NSHOST'] = host
 
 def source_shell_script(path):
+    source_shell_scripts([path])
+
+def _parse_env0(data):
+    return dict(x.split('=',1) for x in data.split('\0') if '=' in x)
+
+def _sane_env0(data):
+    """Whether data is a complete env -0 dump, nothing else written into it"""
+    if not data.endswith('\0'):
+        return False
+    for item in data[:-1].split('\0'):
+        key = item.split('=',1)[0]
+        if '=' not in item or not key or any(x.isspace() for x in key):
+            return False
+    return True
+
+def _script_key(paths):
+    key = hashlib.sha1()
+    for path in paths:
+        with open(path,'rb') as f:
+            content = f.read()
+        key.update('{0}\0{1}\0{2}\0'.format(
+            os.path.abspath(path),os.stat(path).st_mtime,
+            hashlib.sha1(content).hexdigest()).encode('utf-8'))
+    return key.hexdigest()
+
+def source_shell_scripts(paths, cachedir=None):
+    """Source the scripts in order in a single shell and apply the changes
+
+    Only the variables the scripts changed are taken over, dumped with
+    env -0 so multi line values survive. The changes are cached by content
+    hash and mtime of the scripts, so unchanged scripts are never executed
+    again. As for the environment snapshots, values which were prepended or
+    appended to are stored as such and apply to the current environment.
+    """
+    readable = []
+    for path in paths:
+        if os.path.isfile(path) and os.access(path,os.R_OK):
+            readable.append(path)
+        else:
+            logger.warning('skipping {0}, it is missing or not readable'.format(path))
+    paths = readable
+    if not paths:
+        return
+    if cachedir is None:
+        cachedir = os.path.join(getCacheDir(),'salome_launcher','env_sh')
+    cachefile = os.path.join(cachedir,'{0}.json'.format(_script_key(paths)))
+    try:
+        with open(cachefile,'r') as store:
+            cached = json.load(store)
+        apply_env_changes(cached['changes'],cached['unset'])
+        return
+    except (IOError,ValueError,KeyError):
+        pass
+    mark = '__SALOME_LAUNCHER_SOURCED__'
+    # the marker separates the environment before from the one after and
+    # ends the one after, the output of the scripts goes to stderr
+    script = 'env -0; env -i {0}=1 env -0; {{ {1}; }} >&2; env -0; env -i {0}=1 env -0'.format(
+        mark,'; '.join('. {0}'.format(_quote(os.path.abspath(x))) for x in paths))
     # take from http://pythonwise.blogspot.co.at/2010/04/sourcing-shell-script.html
-    pipe = subprocess.Popen(
-        ". %s; env"%path, stdout=subprocess.PIPE,shell=True)
+    pipe = subprocess.Popen(['sh','-c',script],stdout=subprocess.PIPE)
     data = pipe.communicate()[0]
-    env = dict((line.split("=", 1) for line in data.splitlines()))
-    os.environ.update(env)
+    if not isinstance(data,str):
+        # python 3, decoded like os.environ does, python 2 keeps the bytes
+        data = data.decode(sys.getfilesystemencoding(),'surrogateescape')
+    parts = data.split('{0}=1\0'.format(mark))
+    if len(parts) != 3 or parts[2] or not _sane_env0(parts[1]):
+        # a script exited the shell or wrote to stdout regardless
+        logger.warning('ignoring {0}, sourcing it gave no usable environment'.format(
+            ' '.join(paths)))
+        return
+    before,after = _parse_env0(parts[0]),_parse_env0(parts[1])
+    # the shell itself sets these
+    for key in ('_','SHLVL','PWD','OLDPWD'):
+        before.pop(key,None)
+        after.pop(key,None)
+    changes,unset = env_changes(before,after)
+    apply_env_changes(changes,unset)
+    try:
+        data = json.dumps({'paths':paths,'changes':changes,'unset':unset})
+    except UnicodeDecodeError as e:
+        # python 2 with a value which is no utf-8
+        logger.warning('not caching the environment of {0}: {1}'.format(
+            ' '.join(paths),e))
+        return
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    with open(cachefile,'w') as store:
+        store.write(data)
+
+def _entries(value):
+    return [x for x in value.split(os.pathsep) if x]
+
+def _path_change(old, value):
+    """['path',prefix,suffix] with the entries value adds around old
+
+    None if entries of old are missing in value, which is no addition.
+    """
+    old,new = _entries(old or ''),_entries(value)
+    present = set(old)
+    if not present.issubset(new):
+        return None
+    # added entries in between the old ones count as appended
+    first = new.index(old[0]) if old else len(new)
+    return ['path',[x for x in new[:first] if x not in present],
+            [x for x in new[first:] if x not in present]]
+
+def env_changes(before, after, paths=PATH_VARIABLES):
+    """Return (changes,unset) turning the environment before into after
+
+    changes maps the variable to [action,value], where action is 'set',
+    'prepend' or 'append', so the changes of PATH like variables also apply
+    to other environments. The variables in paths are lists of entries,
+    they map to ['path',prefix,suffix] with the entries added in front and
+    at the end, also if the variable was unset before.
+    """
+    changes = {}
+    for key,value in after.items():
+        old = before.get(key)
+        if old == value:
+            continue
+        change = _path_change(old,value) if key in paths else None
+        if change is not None:
+            changes[key] = change
+        elif old and value.endswith(old):
+            changes[key] = ['prepend',value[:-len(old)]]
+        elif old and value.startswith(old):
+            changes[key] = ['append',value[len(old):]]
+        else:
+            changes[key] = ['set',value]
+    return changes,[key for key in before if key not in after]
+
+def _native(value):
+    """The value as str, json gives unicode on python 2"""
+    if sys.version_info[0] < 3 and isinstance(value,unicode):
+        return value.encode('utf-8')
+    return value
+
+def apply_env_changes(changes, unset=()):
+    """Apply the changes of env_changes to os.environ
+
+    Entries of path changes already in the variable keep their position
+    there, like with PathList, so applying them again adds nothing.
+    """
+    for key,change in changes.items():
+        key = _native(key)
+        action,value = change[0],change[1]
+        if action == 'path':
+            current = _entries(os.environ.get(key,''))
+            seen = set(current)
+            prefix,suffix = [],[]
+            for target,items in ((prefix,value),(suffix,change[2])):
+                for item in items:
+                    item = _native(item)
+                    if item not in seen:
+                        seen.add(item)
+                        target.append(item)
+            os.environ[key] = os.pathsep.join(prefix+current+suffix)
+        elif action == 'prepend':
+            os.environ[key] = _native(value)+os.environ.get(key,'')
+        elif action == 'append':
+            os.environ[key] = os.environ.get(key,'')+_native(value)
+        else:
+            os.environ[key] = _native(value)
+    for key in unset:
+        os.environ.pop(_native(key),None)
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config,sort_keys=True).encode('utf-8')).hexdigest()
+
+def env_inputs(config):
+    """Files and directories the environment set by set_env depends on"""
+    paths = []
+    env_sh = config.get('env_sh',[])
+    if isinstance(env_sh,Iterable) and not isinstance(env_sh,unicode):
+        paths.extend(env_sh)
+    else:
+        paths.append(env_sh)
+    for module,module_config in sorted(config['modules'].items()):
+        for key in ('root','bin','lib','site-packages','shared_modules','resources'):
+            paths.append(module_config[key])
+        # the setenv module could come from any of the PYTHONPATH entries
+        for key in ('bin','lib','site-packages','shared_modules'):
+            paths.append(os.path.join(
+                module_config[key],module.lower()+'_setenv.py'))
+    for key,val in sorted(config.get('env',{}).items()):
+        if isinstance(val,list):
+            paths.extend(val)
+    return paths
+
+def inputs_state(paths):
+    """Dict mapping every path to its mtime, None if it doesn't exist"""
+    state = {}
+    for path in paths:
+        try:
+            state[path] = os.stat(path).st_mtime
+        except OSError:
+            state[path] = None
+    return state
+
+def save_env_snapshot(path, config, before, after=None, paths=()):
+    """Store the changes set_env made to the environment
+
+    before is a copy of os.environ from before set_env, after defaults to the
+    current environment. Values which were only prepended to are stored as
+    prefix, so they apply to the environment of whoever loads the snapshot.
+    paths are the PATH like variables set_env wrote, besides PATH_VARIABLES
+    their entries are merged into the ones of the loading environment.
+    """
+    if after is None:
+        after = os.environ
+    changes,unset = env_changes(before,after,set(PATH_VARIABLES).union(paths))
+    snapshot = {
+        'config':config_hash(config),
+        'inputs':inputs_state(env_inputs(config)),
+        'changes':changes,
+        'unset':unset,
+    }
+    try:
+        data = json.dumps(snapshot)
+    except UnicodeDecodeError as e:
+        # python 2 with a value which is no utf-8, set_env is used instead
+        logger.warning('not saving the environment snapshot: {0}'.format(e))
+        return
+    with open(path,'w') as store:
+        store.write(data)
+
+def load_env_snapshot(path, config):
+    """The snapshot stored at path, None if missing or out of date"""
+    try:
+        with open(path,'r') as store:
+            snapshot = json.load(store)
+    except (IOError,ValueError):
+        return None
+    if snapshot.get('config') != config_hash(config):
+        return None
+    if inputs_state(snapshot['inputs']) != snapshot['inputs']:
+        return None
+    return snapshot
+
+def apply_env_snapshot(snapshot):
+    apply_env_changes(snapshot['changes'],snapshot['unset'])
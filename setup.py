@@ -15,9 +15,13 @@ setup(
         'Programming Language :: Python',
         'Topic :: Software Development',
         ],
-    py_modules=['salome_launcher','setenv','salome_utils'],
+    py_modules=['salome_launcher','setenv','salome_utils','salome_startup',
+                'salome_profile','salome_supervisor',
+                'salome_metrics','salome_limits',
+                'salome_pool','salome_daemon','salome_naming',
+                'salome_importindex'],
     platforms='any',
-    install_requires=['lxml'],
+    install_requires=['lxml','scandir; python_version < "3.5"'],
     entry_points = {
         'console_scripts' :[
             'salome_launcher = salome_launcher:dispatch',
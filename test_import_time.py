@@ -0,0 +1,97 @@
+#  -*- coding: iso-8859-1 -*-
+# startup budget of the commands scripts call many times, like connect_session,
+# each check runs in a fresh interpreter, the best of a few runs counts
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# seconds, generous for a loaded machine, a heavy import exceeds them anyway
+IMPORT_BUDGET = 0.3
+HELP_BUDGET = 1.0
+RUNS = 3
+# only the commands which need them may import these
+HEAVY = ('omniORB','CosNaming','lxml','multiprocessing.pool')
+
+try:
+    import opster
+except ImportError:
+    opster = None
+
+
+def run(args, extra_env={}):
+    env = dict(os.environ)
+    env.update(extra_env)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [HERE]+[x for x in env.get('PYTHONPATH','').split(os.pathsep) if x])
+    best,outputs = None,[]
+    for i in range(RUNS):
+        start = time.time()
+        proc = subprocess.Popen([sys.executable]+args,cwd=HERE,env=env,
+                                stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out,err = proc.communicate()
+        elapsed = time.time()-start
+        if proc.returncode != 0:
+            raise AssertionError('{0} failed: {1}'.format(
+                ' '.join(args),err.decode('utf-8','replace')))
+        best = elapsed if best is None else min(best,elapsed)
+        outputs.append(out.decode('utf-8'))
+    return best,outputs
+
+
+@unittest.skipIf(opster is None,'opster is not installed')
+class TestImportTime(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        code = ('import sys, salome_launcher\n'
+                'print(",".join(x for x in {0!r} if x in sys.modules))'.format(HEAVY))
+        elapsed,outputs = run(['-c',code])
+        self.assertEqual(outputs[0].strip(),'')
+
+    def test_import_budget(self):
+        code = ('import time\n'
+                'start = time.time()\n'
+                'import salome_launcher\n'
+                'print(time.time()-start)')
+        elapsed,outputs = run(['-c',code])
+        self.assertLess(min(float(x) for x in outputs),IMPORT_BUDGET)
+
+    def test_help_budget(self):
+        elapsed,outputs = run(['salome_launcher.py','--help'])
+        self.assertLess(elapsed,HELP_BUDGET)
+
+    def test_connect_session_budget(self):
+        import setenv
+        tmp = tempfile.mkdtemp()
+        try:
+            # the cache entry of a running session with an up to date snapshot
+            cachedir = os.path.join(tmp,'salome_launcher')
+            os.mkdir(cachedir)
+            config = {'modules':{}}
+            with open(os.path.join(cachedir,'127.0.0.1:2815.json'),'w') as store:
+                json.dump(config,store)
+            setenv.save_env_snapshot(
+                os.path.join(cachedir,'127.0.0.1:2815.env.json'),config,
+                {},{'SALOME_TEST_SNAPSHOT':'applied'})
+            # the shell connect_session execs is left out
+            code = ('import os\n'
+                    'os.execvp = lambda *args: None\n'
+                    'import salome_launcher\n'
+                    'assert salome_launcher.connect_session(args="true") is not False\n'
+                    'print(os.environ.get("SALOME_TEST_SNAPSHOT"))')
+            elapsed,outputs = run(['-c',code],{'XDG_CACHE_HOME':tmp,
+                                               'XDG_RUNTIME_DIR':tmp})
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(outputs[0].strip(),'applied')
+        self.assertLess(elapsed,HELP_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()